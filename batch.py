@@ -0,0 +1,181 @@
+###############################################################################
+# Project: Polyhedral Dice Statistical Analysis (Diceview)
+# File   : batch.py
+#
+# Headless batch analysis of recorded frames.
+#
+# Copyright (c) 2020 Diceview Team
+# Released under the MIT License.
+#
+#   Date      SCR  Comment                                        Eng
+# -----------------------------------------------------------------------------
+#   20261017       Created                                        agent
+#
+###############################################################################
+
+import argparse
+import collections
+import csv
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+import dietypes
+import review
+import vision
+
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+
+def iter_frames(paths):
+	# Yield (source, frame number, image) for every frame in the given image files, image directories and video
+	# files, decoding lazily so only the frames in flight are held in memory.
+	for path in paths:
+		if os.path.isdir(path):
+			for name in sorted(os.listdir(path)):
+				if name.lower().endswith(IMAGE_EXTS):
+					yield from iter_frames([os.path.join(path, name)])
+		elif path.lower().endswith(IMAGE_EXTS):
+			image = cv2.imread(path)
+			if image is None:
+				print("Couldn't read {}!".format(path), file=sys.stderr)
+				continue
+			yield path, 0, image
+		else:
+			cap = cv2.VideoCapture(path)
+			if not cap.isOpened():
+				print("Couldn't open {}!".format(path), file=sys.stderr)
+				continue
+			num = 0
+			while True:
+				ok, image = cap.read()
+				if not ok:
+					break
+				yield path, num, image
+				num += 1
+			cap.release()
+
+
+def bounded_map(executor, func, items, limit):
+	# Like executor.map, but only pulls limit items ahead of the results so a long input isn't decoded all at once.
+	pending = collections.deque()
+	for item in items:
+		pending.append(executor.submit(func, item))
+		if len(pending) >= limit:
+			yield pending.popleft().result()
+	while pending:
+		yield pending.popleft().result()
+
+
+class CsvWriter(object):
+	def __init__(self, f):
+		self._writer = csv.writer(f)
+		self._writer.writerow(['source', 'frame', 'count', 'dice', 'seconds'])
+	
+	def write(self, source, frame, dice, seconds):
+		rolls = ' '.join('{}:{}'.format(det.kind, det.value) for det in dice)
+		self._writer.writerow([source, frame, len(dice), rolls, '{:.4f}'.format(seconds)])
+
+
+class JsonlWriter(object):
+	def __init__(self, f):
+		self._f = f
+	
+	def write(self, source, frame, dice, seconds):
+		rolls = [{'kind': det.kind, 'value': det.value, 'x': round(det.pt[0], 1), 'y': round(det.pt[1], 1),
+			'score': round(det.score, 3), 'margin': round(det.margin, 3)} for det in dice]
+		rec = {'source': source, 'frame': frame, 'dice': rolls, 'seconds': round(seconds, 4)}
+		self._f.write(json.dumps(rec) + '\n')
+
+
+class BatchAnalyser(object):
+	# Runs frames through DiceFinders on a thread pool. Each thread gets its own finder, since a finder's background
+	# buffers are per frame, and all of them share one die matching pool and review queue.
+	def __init__(self, pool, jobs=None, review=None):
+		self.pool = pool
+		self.jobs = jobs or os.cpu_count() or 1
+		self.review = review
+		self.finders = []
+		self._local = threading.local()
+	
+	def _analyse(self, item):
+		source, num, image = item
+		finder = getattr(self._local, 'finder', None)
+		if finder is None:
+			finder = vision.DiceFinder(self.pool, review=self.review)
+			self._local.finder = finder
+			self.finders.append(finder)
+		start = time.perf_counter()
+		dice, _ = finder.process(image)
+		return source, num, dice, time.perf_counter() - start
+	
+	def run(self, frames):
+		# Yield (source, frame number, dice, seconds) in input order.
+		with ThreadPoolExecutor(self.jobs, thread_name_prefix='frame') as executor:
+			yield from bounded_map(executor, self._analyse, frames, self.jobs * 2)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Score recorded dice tray frames without the GUI or hardware.")
+	parser.add_argument('inputs', nargs='+', help="image files, image directories or video files")
+	parser.add_argument('-o', '--output', default='-', help="results file, .csv or .jsonl (default: CSV on stdout)")
+	parser.add_argument('-f', '--format', choices=['csv', 'jsonl'], help="output format, overriding the extension")
+	parser.add_argument('-j', '--jobs', type=int, default=None, help="frames analysed in parallel")
+	parser.add_argument('-w', '--workers', type=int, default=None, help="die matching workers")
+	parser.add_argument('--processes', action='store_true', help="match dice in worker processes instead of threads")
+	parser.add_argument('-t', '--types', nargs='+', help="die types to recognise (default: all with references)")
+	parser.add_argument('-r', '--recognizer', choices=vision.RECOGNIZERS, default='auto', help="die face recogniser")
+	parser.add_argument('--review', metavar='DIR', help="save unrecognised and uncertain crops to a review queue")
+	args = parser.parse_args(argv)
+	
+	fmt = args.format
+	if fmt is None:
+		fmt = 'jsonl' if args.output.endswith('.jsonl') else 'csv'
+	
+	types = dietypes.active()
+	if args.types:
+		types = [dietypes.get(name) for name in args.types]
+	pool = vision.open_match_pool(args.workers, args.processes, types, args.recognizer)
+	if pool is None:
+		return 1
+	
+	out = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+	writer = JsonlWriter(out) if fmt == 'jsonl' else CsvWriter(out)
+	queue = review.ReviewQueue(args.review) if args.review else None
+	analyser = BatchAnalyser(pool, args.jobs, queue)
+	
+	frames = 0
+	dice = 0
+	busy = 0.0
+	start = time.perf_counter()
+	try:
+		for source, num, rolls, seconds in analyser.run(iter_frames(args.inputs)):
+			writer.write(source, num, rolls, seconds)
+			frames += 1
+			dice += len(rolls)
+			busy += seconds
+	finally:
+		pool.stop()
+		if queue is not None:
+			queue.flush()
+		if out is not sys.stdout:
+			out.close()
+	elapsed = time.perf_counter() - start
+	
+	print("{:d} frames, {:d} dice in {:.2f} s: {:.2f} frames/s, {:.2f} dice/s, {:.1f} ms/frame".format(
+		frames, dice, elapsed, frames / max(elapsed, 1e-9), dice / max(elapsed, 1e-9),
+		1000.0 * busy / max(frames, 1)), file=sys.stderr)
+	rejected = sum(finder.rejected for finder in analyser.finders)
+	if rejected:
+		print("{:d} dice not recognised or too uncertain".format(rejected), file=sys.stderr)
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
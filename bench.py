@@ -0,0 +1,207 @@
+###############################################################################
+# Project: Polyhedral Dice Statistical Analysis (Diceview)
+# File   : bench.py
+#
+# Benchmarks for the vision hot path.
+#
+# Copyright (c) 2020 Diceview Team
+# Released under the MIT License.
+#
+#   Date      SCR  Comment                                        Eng
+# -----------------------------------------------------------------------------
+#   20261017       Created                                        agent
+#
+###############################################################################
+
+import argparse
+import collections
+import json
+import os
+import random
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from sim import load_faces, synth_tray
+import dietypes
+import vision
+
+
+STAGES = ('grey', 'subtract', 'foreground', 'detect', 'match')
+# Differences smaller than this are treated as timer noise when comparing against a baseline
+NOISE_MS = 0.05
+
+
+def key_value(key):
+	return None if key is None else dietypes.parse_key(key)[1]
+
+
+def time_frame(finder, image):
+	# Run one frame through the pipeline stage by stage.
+	# Returns a dict of stage -> seconds, the per-die match seconds and the matched face keys.
+	bg = finder.background
+	if bg.shape != image.shape[:2]:
+		bg.fit(image.shape[:2])
+	
+	t0 = time.perf_counter()
+	grey = bg.grey(image)
+	t1 = time.perf_counter()
+	masked = bg.subtract(grey)
+	t2 = time.perf_counter()
+	fg = bg.foreground(masked)
+	t3 = time.perf_counter()
+	keypoints = finder.detect(fg)
+	t4 = time.perf_counter()
+	keys = []
+	die_times = []
+	if finder.pool is not None:
+		results, die_times, _ = finder.pool.match_scored(finder.crop(image, keypoints))
+		keys = [key for key, _, _ in results]
+	t5 = time.perf_counter()
+	
+	stages = dict(zip(STAGES, (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4)))
+	return stages, die_times, keys
+
+
+def run_fixture(finder, frames, repeat):
+	# Time every (frame, truth) pair repeat times. Truth may be None for frames with unknown contents.
+	stages = collections.defaultdict(list)
+	die_times = []
+	totals = []
+	placed = 0
+	correct = 0
+	for _ in range(repeat):
+		for frame, truth in frames:
+			times, per_die, keys = time_frame(finder, frame)
+			for stage, t in times.items():
+				stages[stage].append(t)
+			die_times.extend(per_die)
+			totals.append(sum(times.values()))
+			if truth is not None:
+				found = collections.Counter(key_value(k) for k in keys if k is not None)
+				placed += len(truth)
+				correct += sum((found & collections.Counter(truth)).values())
+	
+	result = {stage: 1000.0 * float(np.mean(stages[stage])) for stage in STAGES}
+	result['per_die'] = 1000.0 * float(np.mean(die_times)) if die_times else 0.0
+	result['total'] = 1000.0 * float(np.mean(totals))
+	result['p95'] = 1000.0 * float(np.percentile(totals, 95))
+	result['fps'] = 1000.0 / result['total'] if result['total'] > 0 else 0.0
+	if placed:
+		result['accuracy'] = correct / float(placed)
+	return result
+
+
+def match_fixture(finder, faces, repeat):
+	# Matching stage only, on the reference face crops themselves.
+	crops = [cv2.cvtColor(faces[value], cv2.COLOR_GRAY2BGR) for value in sorted(faces)]
+	die_times = []
+	totals = []
+	correct = 0
+	# fps here counts crops, not frames
+	for _ in range(repeat):
+		start = time.perf_counter()
+		results, per_die, _ = finder.pool.match_scored(crops)
+		totals.append(time.perf_counter() - start)
+		keys = [key for key, _, _ in results]
+		die_times.extend(per_die)
+		correct += sum(1 for value, key in zip(sorted(faces), keys) if key_value(key) == value)
+	return {
+		'match': 1000.0 * float(np.mean(totals)),
+		'per_die': 1000.0 * float(np.mean(die_times)),
+		'total': 1000.0 * float(np.mean(totals)),
+		'fps': len(crops) / float(np.mean(totals)),
+		'accuracy': correct / float(len(crops) * repeat)
+	}
+
+
+def run(args):
+	pool = vision.open_match_pool(args.workers, args.processes, backend=args.recognizer)
+	finder = vision.DiceFinder(pool)
+	ref = cv2.imread(os.path.join('refim', 'ref.jpg'))
+	faces = load_faces()
+	rng = random.Random(args.seed)
+	
+	results = dict()
+	try:
+		if pool is not None:
+			# Warm up the per-thread matchers so their setup isn't timed.
+			pool.match([cv2.cvtColor(faces[1], cv2.COLOR_GRAY2BGR)] * pool.workers)
+			results['refim_faces'] = match_fixture(finder, faces, args.repeat)
+		results['empty_tray'] = run_fixture(finder, [(ref, [])], args.repeat * args.frames)
+		for count in args.dice:
+			frames = [synth_tray(ref, faces, count, rng) for _ in range(args.frames)]
+			results['tray_{:d}'.format(count)] = run_fixture(finder, frames, args.repeat)
+	finally:
+		if pool is not None:
+			pool.stop()
+	return results
+
+
+def print_results(results, baseline=None, tolerance=0.1):
+	# Print a table of ms per stage. With a baseline, each cell also shows the relative change and regressions beyond
+	# the tolerance are counted and returned.
+	columns = STAGES + ('per_die', 'total', 'fps')
+	print("{:<14}".format("fixture") + "".join("{:>18}".format(c) for c in columns) + "{:>10}".format("accuracy"))
+	regressions = 0
+	for name, result in results.items():
+		row = "{:<14}".format(name)
+		for column in columns:
+			value = result.get(column)
+			if value is None:
+				row += "{:>18}".format("-")
+				continue
+			cell = "{:.2f}".format(value)
+			old = (baseline or {}).get(name, {}).get(column)
+			if old:
+				change = (value - old) / old
+				cell += " ({:+.0%})".format(change)
+				# Higher is better for fps, lower is better for everything else
+				worse = -change if column == 'fps' else change
+				if worse > tolerance and (column == 'fps' or abs(value - old) > NOISE_MS):
+					cell += "!"
+					regressions += 1
+			row += "{:>18}".format(cell)
+		accuracy = result.get('accuracy')
+		row += "{:>10}".format("-" if accuracy is None else "{:.1%}".format(accuracy))
+		print(row)
+	return regressions
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark the vision pipeline on reference and synthetic frames.")
+	parser.add_argument('--frames', type=int, default=10, help="synthetic frames per dice count")
+	parser.add_argument('--repeat', type=int, default=3, help="passes over each fixture")
+	parser.add_argument('--dice', type=int, nargs='+', default=[1, 3, 5],
+		help="dice counts for synthetic trays; about five fit without overlapping")
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('-w', '--workers', type=int, default=None, help="die matching workers")
+	parser.add_argument('--processes', action='store_true', help="match dice in worker processes instead of threads")
+	parser.add_argument('-r', '--recognizer', choices=vision.RECOGNIZERS, default='auto', help="die face recogniser")
+	parser.add_argument('--save', metavar='FILE', help="save results as a baseline")
+	parser.add_argument('--compare', metavar='FILE', help="compare against a saved baseline")
+	parser.add_argument('--tolerance', type=float, default=0.1, help="relative slowdown counted as a regression")
+	args = parser.parse_args(argv)
+	
+	results = run(args)
+	
+	baseline = None
+	if args.compare:
+		with open(args.compare) as f:
+			baseline = json.load(f)['results']
+	regressions = print_results(results, baseline, args.tolerance)
+	
+	if args.save:
+		with open(args.save, 'w') as f:
+			saved = {'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'args': vars(args), 'results': results}
+			json.dump(saved, f, indent=1)
+	if regressions:
+		print("{:d} regressions beyond {:.0%}".format(regressions, args.tolerance))
+		return 1
+	return 0
+
+
+if __name__ == "__main__":
+	sys.exit(main())
@@ -14,7 +14,10 @@
 ###############################################################################
 
 import cv2
+import os
 import platform
+import threading
+import time
 
 
 class BaseCam(object):
@@ -24,16 +27,84 @@ class BaseCam(object):
 	def stop(self):
 		raise NotImplementedError()
 	
+	def ready(self):
+		raise NotImplementedError()
+	
 	def get_frame(self):
 		raise NotImplementedError()
 
 
+class CaptureProfile(object):
+	# What the vision stage needs out of a camera: a centred crop of the sensor (a fraction of each dimension, shifted
+	# by a pixel offset), the output size and whether to deliver single channel greyscale. Backends that can do this in
+	# hardware do; the rest fall back to apply().
+	def __init__(self, crop=None, offset=(0, 0), size=None, grey=False):
+		self.crop = crop
+		self.offset = offset
+		self.size = size
+		self.grey = grey
+	
+	def crop_rect(self, width, height):
+		# (x, y, w, h) of the crop in a width x height frame.
+		if self.crop is None:
+			return 0, 0, width, height
+		w = int(width * self.crop)
+		h = int(height * self.crop)
+		x = int(width * 0.5 - w * 0.5) + self.offset[0]
+		y = int(height * 0.5 - h * 0.5) + self.offset[1]
+		return x, y, w, h
+	
+	def out_size(self, width, height):
+		# (w, h) of the delivered frames.
+		if self.size is not None:
+			return self.size
+		_, _, w, h = self.crop_rect(width, height)
+		return w, h
+	
+	def apply(self, frame):
+		# Software version of the profile, for backends that can't do it at capture.
+		x, y, w, h = self.crop_rect(frame.shape[1], frame.shape[0])
+		frame = frame[y:y + h, x:x + w]
+		if self.size is not None and (w, h) != tuple(self.size):
+			frame = cv2.resize(frame, tuple(self.size), interpolation=cv2.INTER_AREA)
+		if self.grey and frame.ndim == 3:
+			frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+		return frame
+
+
+PROFILES = {
+	# Full sensor frames, cropped to the tray in numpy. What JetsonCam used to do.
+	'legacy': CaptureProfile(crop=0.35, offset=(0, 50)),
+	# The same tray region, cropped in the capture pipeline. 1142x862 from the 3264x2464 sensor, the size of ref.jpg.
+	'tray': CaptureProfile(crop=0.35, offset=(0, 50)),
+	'tray-grey': CaptureProfile(crop=0.35, offset=(0, 50), grey=True),
+	'tray-half': CaptureProfile(crop=0.35, offset=(0, 50), size=(571, 431)),
+	# Small greyscale stream, enough to see whether anything is moving
+	'preview': CaptureProfile(crop=0.35, offset=(0, 50), size=(286, 216), grey=True)
+}
+
+
+def get_profile(profile):
+	if profile is None or isinstance(profile, CaptureProfile):
+		return profile
+	return PROFILES[profile]
+
+
 class JetsonCam(BaseCam):
-	def __init__(self):
+	SENSOR_SIZE = (3264, 2464)
+	FRAMERATE = 21
+	
+	def __init__(self, profile='tray', sensor_id=0):
+		# Parameter profile is a CaptureProfile or a PROFILES name. Except for 'legacy', its crop, scale and format are
+		# done by nvvidconv before the frame ever reaches the CPU. Parameter sensor_id picks the CSI camera on boards
+		# with more than one.
 		self._cap = None
+		self.sensor_id = sensor_id
+		self._legacy = profile == 'legacy'
+		self.profile = get_profile(profile)
 	
 	def start(self):
-		self._cap = cv2.VideoCapture(self.gstreamer_pipeline(flip_method=0), cv2.CAP_GSTREAMER)
+		self._cap = cv2.VideoCapture(self.pipeline(), cv2.CAP_GSTREAMER)
 		if not self._cap.isOpened():
 			print("Couldn't open camera!")
 	
@@ -45,13 +116,23 @@ class JetsonCam(BaseCam):
 		return self._cap is not None and self._cap.isOpened()
 	
 	def get_frame(self):
-		_, frame = self._cap.read()
-		c_size = 0.35
-		w = int(frame.shape[1] * c_size)
-		h = int(frame.shape[0] * c_size)
-		x = int(frame.shape[1] * 0.5 - w * 0.5)
-		y = int(frame.shape[0] * 0.5 - h * 0.5) + 50
-		return frame[y:y + h, x:x + w]
+		retval, frame = self._cap.read()
+		if not retval:
+			return None
+		if self._legacy:
+			return self.profile.apply(frame)
+		return frame
+	
+	def pipeline(self):
+		width, height = self.SENSOR_SIZE
+		if self._legacy:
+			return self.gstreamer_pipeline(
+				width, height, width, height, self.FRAMERATE, flip_method=0, sensor_id=self.sensor_id)
+		x, y, w, h = self.profile.crop_rect(width, height)
+		out_w, out_h = self.profile.out_size(width, height)
+		return self.gstreamer_pipeline(
+			width, height, out_w, out_h, self.FRAMERATE, flip_method=0, crop=(x, y, w, h), grey=self.profile.grey,
+			sensor_id=self.sensor_id)
 	
 	@staticmethod
 	def gstreamer_pipeline(
@@ -60,40 +141,66 @@ class JetsonCam(BaseCam):
 			display_width=3264,
 			display_height=2464,
 			framerate=21,
-			flip_method=0
+			flip_method=0,
+			crop=None,
+			grey=False,
+			sensor_id=0
 	):
+		# Parameter crop is (x, y, w, h) in sensor pixels for nvvidconv to cut out before scaling to the display size.
+		# With grey, nvvidconv hands over GRAY8 and there's no videoconvert at all.
+		crop_props = ""
+		if crop is not None:
+			x, y, w, h = crop
+			crop_props = " left=%d right=%d top=%d bottom=%d" % (x, x + w, y, y + h)
+		if grey:
+			convert = (
+				"video/x-raw, width=(int)%d, height=(int)%d, format=(string)GRAY8 ! " % (display_width, display_height)
+			)
+		else:
+			convert = (
+				"video/x-raw, width=(int)%d, height=(int)%d, format=(string)BGRx ! "
+				"videoconvert ! "
+				"video/x-raw, format=(string)BGR ! " % (display_width, display_height)
+			)
 		return (
-				"nvarguscamerasrc ! "
+				"nvarguscamerasrc sensor-id=%d ! "
 				"video/x-raw(memory:NVMM), "
 				"width=(int)%d, height=(int)%d, "
 				"wbmode=0, "
 				"format=(string)NV12, framerate=(fraction)%d/1 ! "
-				"nvvidconv flip-method=%d ! "
-				"video/x-raw, width=(int)%d, height=(int)%d, format=(string)BGRx ! "
-				"videoconvert ! "
-				"video/x-raw, format=(string)BGR ! appsink"
+				"nvvidconv flip-method=%d%s ! "
+				"%s"
+				"appsink"
 				% (
+					sensor_id,
 					capture_width,
 					capture_height,
 					framerate,
 					flip_method,
-					display_width,
-					display_height
+					crop_props,
+					convert
 				)
 		)
 
 
 class USBCam(BaseCam):
-	def __init__(self, camidx = 0):
+	def __init__(self, camidx = 0, profile=None):
+		# Parameter profile is optional. Its size is asked of the driver; anything the driver doesn't do is applied in
+		# software. Without one, frames come at the highest resolution the camera offers.
 		self._cap = None
 		self._camidx = camidx
+		self.profile = get_profile(profile)
 	
 	def start(self):
 		self._cap = cv2.VideoCapture(cv2.CAP_DSHOW + self._camidx)
 		if not self._cap.isOpened():
 			print("Couldn't open camera!")
-		self._cap.set(cv2.CAP_PROP_FRAME_WIDTH, 100000)
-		self._cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 100000)
+		if self.profile is not None and self.profile.size is not None and self.profile.crop is None:
+			self._cap.set(cv2.CAP_PROP_FRAME_WIDTH, self.profile.size[0])
+			self._cap.set(cv2.CAP_PROP_FRAME_HEIGHT, self.profile.size[1])
+		else:
+			self._cap.set(cv2.CAP_PROP_FRAME_WIDTH, 100000)
+			self._cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 100000)
 	
 	def stop(self):
 		self._cap.release()
@@ -106,9 +213,159 @@ class USBCam(BaseCam):
 		retval, frame = self._cap.read()
 		if not retval:
 			frame = None
+		elif self.profile is not None:
+			frame = self.profile.apply(frame)
+		return frame
+
+
+class FileCam(BaseCam):
+	# Replays recorded frames from an image directory or a video file as if they came from a camera, paced to fps and
+	# put through the capture profile in software. Loops back to the start when it runs out, unless loop is False.
+	IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+	
+	def __init__(self, path, profile=None, fps=21, loop=True):
+		self.path = path
+		self.profile = get_profile(profile)
+		self.fps = fps
+		self.loop = loop
+		self._cap = None
+		self._files = None
+		self._next = 0
+		self._open = False
+		self._due = 0.0
+	
+	def start(self):
+		if os.path.isdir(self.path):
+			names = [name for name in sorted(os.listdir(self.path)) if name.lower().endswith(self.IMAGE_EXTS)]
+			self._files = [os.path.join(self.path, name) for name in names]
+			self._open = len(self._files) > 0
+		else:
+			self._cap = cv2.VideoCapture(self.path)
+			self._open = self._cap.isOpened()
+		self._next = 0
+		self._due = time.monotonic()
+		if not self._open:
+			print("Couldn't open camera!")
+	
+	def stop(self):
+		if self._cap is not None:
+			self._cap.release()
+			self._cap = None
+		self._open = False
+	
+	def ready(self):
+		return self._open
+	
+	def _read(self):
+		if self._files is not None:
+			if self._next >= len(self._files):
+				if not self.loop:
+					return None
+				self._next = 0
+			frame = cv2.imread(self._files[self._next])
+			self._next += 1
+			return frame
+		retval, frame = self._cap.read()
+		if not retval and self.loop:
+			self._cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+			retval, frame = self._cap.read()
+		return frame if retval else None
+	
+	def get_frame(self):
+		if self.fps:
+			self._due += 1.0 / self.fps
+			delay = self._due - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+			else:
+				self._due = time.monotonic()
+		frame = self._read()
+		if frame is None:
+			self._open = False
+			return None
+		if self.profile is not None:
+			frame = self.profile.apply(frame)
 		return frame
 
 
+class FrameGrabber(BaseCam):
+	# Wraps a camera with a background thread that reads frames continuously, so the driver's buffers never hold
+	# stale frames and grab latency is off the caller's critical path. Only the latest frame is kept, with no copy,
+	# stamped with the time.monotonic() at which the read that produced it began. Callers must treat frames as
+	# read-only.
+	def __init__(self, cam):
+		self.cam = cam
+		self._cond = threading.Condition()
+		self._thread = None
+		self._running = False
+		self._frame = None
+		self._stamp = None
+		self._seq = 0
+	
+	def start(self):
+		self.cam.start()
+		with self._cond:
+			self._running = True
+			self._frame = None
+			self._stamp = None
+		self._thread = threading.Thread(target=self._run, name='grab', daemon=True)
+		self._thread.start()
+	
+	def stop(self):
+		with self._cond:
+			self._running = False
+			self._cond.notify_all()
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+		self.cam.stop()
+	
+	def ready(self):
+		return self.cam.ready()
+	
+	def _run(self):
+		while True:
+			with self._cond:
+				if not self._running:
+					break
+			if not self.cam.ready():
+				time.sleep(0.1)
+				continue
+			stamp = time.monotonic()
+			frame = self.cam.get_frame()
+			if frame is None:
+				time.sleep(0.005)
+				continue
+			with self._cond:
+				self._frame = frame
+				self._stamp = stamp
+				self._seq += 1
+				self._cond.notify_all()
+	
+	def latest(self):
+		# Returns the latest frame and its stamp, or (None, None) before the first frame.
+		with self._cond:
+			return self._frame, self._stamp
+	
+	def next_frame(self, t, timeout=None):
+		# Block until a frame is captured starting at or after monotonic time t.
+		# Returns the frame and its stamp, or (None, None) on timeout or stop.
+		with self._cond:
+			self._cond.wait_for(
+				lambda: not self._running or (self._stamp is not None and self._stamp >= t), timeout=timeout)
+			if self._stamp is None or self._stamp < t:
+				return None, None
+			return self._frame, self._stamp
+	
+	def get_frame_after(self, t, timeout=None):
+		# Like next_frame, without the stamp. Returns None on timeout or stop.
+		return self.next_frame(t, timeout)[0]
+	
+	def get_frame(self):
+		# A frame captured entirely after this call, never an old buffered one.
+		return self.get_frame_after(time.monotonic(), timeout=1.0)
+
+
 def get_best_cam():
 	if platform.os.name == "nt":
 		return USBCam
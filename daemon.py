@@ -0,0 +1,500 @@
+###############################################################################
+# Project: Polyhedral Dice Statistical Analysis (Diceview)
+# File   : daemon.py
+#
+# Headless rig daemon, and the client viewers use to attach to it.
+#
+# Copyright (c) 2020 Diceview Team
+# Released under the MIT License.
+#
+#   Date      SCR  Comment                                        Eng
+# -----------------------------------------------------------------------------
+#   20261017       Created                                        agent
+#
+###############################################################################
+
+import argparse
+import json
+import os
+import queue
+import socket
+import sys
+import threading
+import time
+from multiprocessing import shared_memory
+
+import cv2
+import numpy as np
+
+from vision import VisionThread, Detection
+from motion import Motion
+from rigs import Rig, make_cam
+from rolllog import LOG_PATH
+from sequential import SequentialTest
+import dietypes
+import sim
+
+
+HOST = '127.0.0.1'
+PORT = 7420
+# Preview frames are published at display resolution, never at camera resolution
+PREVIEW_SIZE = (960, 540)
+# Preview header: sequence number (odd while a frame is being written), width, height, actuation
+HEADER = 64
+HEADER_FIELDS = 4
+
+
+def preview_name(port):
+	return 'diceview-preview-{:d}'.format(port)
+
+
+def _header(shm):
+	return np.ndarray((HEADER_FIELDS,), dtype=np.int64, buffer=shm.buf)
+
+
+class PreviewWriter(object):
+	# Latest annotated frame, scaled to size, in a named shared memory block any number of processes can read without
+	# the daemon knowing or waiting for them. Guarded by a sequence number rather than a lock: it is odd while a frame
+	# is being copied in, and readers retry if it changed under them.
+	def __init__(self, name, size=PREVIEW_SIZE):
+		self.name = name
+		self.size = size
+		self._shm = None
+		self._header = None
+		self._image = None
+		self._scratch = None
+	
+	def open(self):
+		width, height = self.size
+		nbytes = HEADER + width * height * 3
+		try:
+			self._shm = shared_memory.SharedMemory(self.name, create=True, size=nbytes)
+		except FileExistsError:
+			# Left behind by a daemon that didn't exit cleanly
+			stale = shared_memory.SharedMemory(self.name)
+			stale.close()
+			stale.unlink()
+			self._shm = shared_memory.SharedMemory(self.name, create=True, size=nbytes)
+		self._header = _header(self._shm)
+		self._header[:] = (0, width, height, -1)
+		self._image = np.ndarray((height, width, 3), dtype=np.uint8, buffer=self._shm.buf, offset=HEADER)
+		self._scratch = np.empty_like(self._image)
+	
+	def write(self, frame, actuation):
+		if frame.ndim == 2:
+			frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR)
+		# Scale outside the critical section, so readers only ever wait for a copy
+		cv2.resize(frame, self.size, dst=self._scratch, interpolation=cv2.INTER_AREA)
+		seq = int(self._header[0])
+		self._header[0] = seq + 1
+		self._image[...] = self._scratch
+		self._header[3] = actuation
+		self._header[0] = seq + 2
+	
+	def close(self):
+		if self._shm is None:
+			return
+		self._header = None
+		self._image = None
+		self._shm.close()
+		self._shm.unlink()
+		self._shm = None
+
+
+class PreviewReader(object):
+	# Viewer side of PreviewWriter.
+	RETRIES = 5
+	
+	def __init__(self, name):
+		self.name = name
+		self.frame = None
+		self.actuation = -1
+		self._shm = None
+		self._header = None
+		self._image = None
+		self._seq = 0
+	
+	def open(self):
+		try:
+			self._shm = shared_memory.SharedMemory(self.name)
+		except FileNotFoundError:
+			print("Couldn't open preview " + self.name + "!")
+			return False
+		if os.name == 'posix':
+			# Attaching registers the block with this process's resource tracker, which would then remove it from
+			# under the daemon when the viewer exits
+			try:
+				from multiprocessing import resource_tracker
+				resource_tracker.unregister(self._shm._name, 'shared_memory')
+			except (ImportError, AttributeError):
+				pass
+		self._header = _header(self._shm)
+		width, height = int(self._header[1]), int(self._header[2])
+		self._image = np.ndarray((height, width, 3), dtype=np.uint8, buffer=self._shm.buf, offset=HEADER)
+		return True
+	
+	def read(self):
+		# Returns the newest complete frame, copied only if it changed since the last read, or None before the first.
+		if self._header is None:
+			return self.frame
+		for _ in range(self.RETRIES):
+			seq = int(self._header[0])
+			if seq == self._seq:
+				break
+			if seq % 2:
+				time.sleep(0.001)
+				continue
+			frame = self._image.copy()
+			actuation = int(self._header[3])
+			if int(self._header[0]) == seq:
+				self._seq = seq
+				self.frame = frame
+				self.actuation = actuation
+				break
+		return self.frame
+	
+	def close(self):
+		if self._shm is None:
+			return
+		self._header = None
+		self._image = None
+		self._shm.close()
+		self._shm = None
+
+
+def encode_result(actuation, dice, ids, rejected):
+	return {
+		'type': 'result',
+		'actuation': actuation,
+		'rejected': rejected,
+		'time': time.time(),
+		'dice': [{'id': int(die), 'kind': det.kind, 'value': int(det.value), 'x': float(det.pt[0]),
+			'y': float(det.pt[1]), 'score': float(det.score), 'margin': float(det.margin)} for det, die in zip(dice, ids)]
+	}
+
+
+def decode_dice(msg):
+	return [Detection(d['kind'], d['value'], (d['x'], d['y']), d['score'], d['margin']) for d in msg['dice']]
+
+
+class ResultServer(object):
+	# Sends each published message to every connected viewer as a line of JSON, and collects the commands they send
+	# back the same way. Each viewer has its own bounded queue and sender thread: a viewer that can't keep up is
+	# disconnected rather than allowed to hold up the rig.
+	CLIENT_QUEUE = 256
+	
+	def __init__(self, host, port, hello):
+		# Parameter hello returns the first message for a new viewer. Messages published while it runs are queued
+		# after it.
+		self.host = host
+		self.port = port
+		self.commands = queue.Queue()
+		self._hello = hello
+		self._sock = None
+		self._clients = []
+		self._lock = threading.Lock()
+	
+	def bind(self):
+		# Claim the port. Viewers that connect wait until start().
+		try:
+			self._sock = socket.create_server((self.host, self.port))
+		except OSError:
+			print("Couldn't listen on {}:{:d}!".format(self.host, self.port))
+			return False
+		return True
+	
+	def start(self):
+		if self._sock is None and not self.bind():
+			return False
+		threading.Thread(target=self._accept, name='accept', daemon=True).start()
+		return True
+	
+	@property
+	def viewers(self):
+		with self._lock:
+			return len(self._clients)
+	
+	def _accept(self):
+		while True:
+			try:
+				conn, _ = self._sock.accept()
+			except OSError:
+				# Closed by stop()
+				return
+			conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+			out = queue.Queue(maxsize=self.CLIENT_QUEUE)
+			with self._lock:
+				out.put(self._line(self._hello()))
+				self._clients.append((conn, out))
+			threading.Thread(target=self._send, args=(conn, out), name='viewer-send', daemon=True).start()
+			threading.Thread(target=self._receive, args=(conn, out), name='viewer-receive', daemon=True).start()
+	
+	@staticmethod
+	def _line(msg):
+		return (json.dumps(msg) + '\n').encode()
+	
+	def _send(self, conn, out):
+		while True:
+			line = out.get()
+			if line is None:
+				break
+			try:
+				conn.sendall(line)
+			except OSError:
+				break
+		self._drop(conn, out)
+	
+	def _receive(self, conn, out):
+		try:
+			for line in conn.makefile('rb'):
+				try:
+					self.commands.put(json.loads(line))
+				except ValueError:
+					print("Couldn't parse viewer command!")
+		except OSError:
+			pass
+		self._drop(conn, out)
+	
+	def _drop(self, conn, out):
+		with self._lock:
+			if (conn, out) not in self._clients:
+				return
+			self._clients.remove((conn, out))
+		try:
+			out.put_nowait(None)
+		except queue.Full:
+			pass
+		try:
+			conn.shutdown(socket.SHUT_RDWR)
+		except OSError:
+			pass
+		conn.close()
+	
+	def publish(self, msg):
+		line = self._line(msg)
+		slow = []
+		with self._lock:
+			for conn, out in self._clients:
+				try:
+					out.put_nowait(line)
+				except queue.Full:
+					slow.append((conn, out))
+		for conn, out in slow:
+			print("Dropping viewer that fell behind!")
+			self._drop(conn, out)
+	
+	def stop(self):
+		if self._sock is not None:
+			self._sock.close()
+		with self._lock:
+			clients = list(self._clients)
+		for conn, out in clients:
+			self._drop(conn, out)
+
+
+class DiceDaemon(object):
+	# Runs the rig with no GUI: a pipelined VisionThread whose results are scored, logged to the roll log and
+	# published to viewers, with the annotated frame going to a PreviewWriter. Viewers never hold up sampling. Unless
+	# keep_rolling, the daemon stops by itself once every die is decided, see SequentialTest. Viewers can send
+	# {"cmd": "pause"} to stop the rig, {"cmd": "sample"} to restart it unless the stop rule says it is done, and
+	# {"cmd": "keep_rolling"} to turn the stop rule off and restart it regardless.
+	POLL = 0.1
+	
+	def __init__(self, vision, log_path=LOG_PATH, host=HOST, port=PORT, preview_size=PREVIEW_SIZE, keep_rolling=False):
+		self.vision = vision
+		self.rig = Rig('daemon', vision, log_path, dietypes.active(), SequentialTest())
+		self.keep_rolling = keep_rolling
+		self.preview = PreviewWriter(preview_name(port), preview_size)
+		self.server = ResultServer(host, port, self._hello)
+		self._lock = threading.Lock()
+	
+	def _hello(self):
+		# Everything up to the actuation given here is on disk, for the viewer to replay; results from it on come over
+		# the socket.
+		with self._lock:
+			self.rig.log.sync()
+			return {
+				'type': 'hello',
+				'actuation': self.rig.actuations,
+				'rejected': self.vision.rejected,
+				'log': os.path.abspath(self.rig.log.path),
+				'preview': self.preview.name
+			}
+	
+	def start(self):
+		# The port is taken first: it keeps a second daemon for the same port from replacing this one's preview.
+		if not self.server.bind():
+			return False
+		self.rig.resume()
+		self.preview.open()
+		self.server.start()
+		self.vision.start()
+		if self.keep_rolling or not self.rig.decided():
+			self.vision.sample()
+		else:
+			self.rig.stopped = True
+			print("Every die is already decided, waiting for a viewer to keep rolling")
+		return True
+	
+	def poll(self):
+		# Handle viewer commands and one result, if one comes within POLL seconds. Returns whether there was a result.
+		while True:
+			try:
+				cmd = self.server.commands.get_nowait().get('cmd')
+			except queue.Empty:
+				break
+			except AttributeError:
+				continue
+			if cmd == 'pause':
+				self.vision.pause()
+				self.rig.stopped = True
+			elif cmd == 'sample':
+				if self.keep_rolling or not self.rig.decided():
+					self.rig.stopped = False
+					self.vision.sample()
+			elif cmd == 'keep_rolling':
+				self.keep_rolling = True
+				self.rig.stopped = False
+				self.vision.sample()
+		
+		try:
+			dice, frame = self.vision.results.get(timeout=self.POLL)
+		except queue.Empty:
+			return False
+		with self._lock:
+			actuation = self.rig.actuations
+			ids = self.rig.record(dice)
+		self.preview.write(frame, actuation)
+		self.server.publish(encode_result(actuation, dice, ids, self.vision.rejected))
+		if not self.keep_rolling and not self.rig.stopped and self.rig.decided():
+			self.vision.pause()
+			self.rig.stopped = True
+			self.server.publish({'type': 'stopped', 'actuation': actuation})
+		return True
+	
+	def stop(self):
+		self.vision.stop()
+		self.vision.join(timeout=10)
+		self.rig.drain()
+		self.server.stop()
+		self.preview.close()
+		self.rig.log.close()
+
+
+class DaemonClient(threading.Thread):
+	# Viewer side connection to a DiceDaemon. Stands in for a pipelined VisionThread: results arrive on the results
+	# queue as (dice, frame) tuples, frame being the newest preview, and sample() and pause() are passed on to the
+	# daemon. Call connect() before start(); it sets actuations to the first actuation that will come over the socket,
+	# everything before that is in the roll log at log_path. Attributes rejected and notify work as for VisionThread,
+	# rejected counting from the daemon's start.
+	def __init__(self, host=HOST, port=PORT, name='daemon-client'):
+		super(DaemonClient, self).__init__(name=name, daemon=True)
+		self.host = host
+		self.port = port
+		self.pipelined = True
+		self.results = queue.Queue()
+		self.actuations = 0
+		self.rejected = 0
+		self.log_path = None
+		self.preview = None
+		self.notify = None
+		self._sock = None
+		self._reader = None
+		self._sendlock = threading.Lock()
+	
+	def connect(self):
+		try:
+			self._sock = socket.create_connection((self.host, self.port))
+			self._reader = self._sock.makefile('rb')
+			hello = json.loads(self._reader.readline())
+		except (OSError, ValueError):
+			print("Couldn't connect to diceview daemon at {}:{:d}!".format(self.host, self.port))
+			return False
+		self.actuations = hello['actuation']
+		self.rejected = hello['rejected']
+		self.log_path = hello['log']
+		self.preview = PreviewReader(hello['preview'])
+		self.preview.open()
+		return True
+	
+	def run(self):
+		try:
+			for line in self._reader:
+				msg = json.loads(line)
+				# A result may have been published while the hello was being made, then it's already in the log
+				if msg.get('type') != 'result' or msg['actuation'] < self.actuations:
+					continue
+				self.rejected = msg['rejected']
+				self.results.put((decode_dice(msg), self.preview.read()))
+				if self.notify is not None:
+					self.notify()
+		except (OSError, ValueError):
+			pass
+		print("Disconnected from diceview daemon")
+	
+	def _send(self, msg):
+		try:
+			with self._sendlock:
+				self._sock.sendall((json.dumps(msg) + '\n').encode())
+		except OSError:
+			print("Couldn't reach diceview daemon!")
+	
+	def sample(self):
+		self._send({'cmd': 'sample'})
+	
+	def pause(self):
+		self._send({'cmd': 'pause'})
+	
+	def keep_rolling(self):
+		# Turn off the daemon's stop rule and restart the rig.
+		self._send({'cmd': 'keep_rolling'})
+	
+	def stop(self):
+		# Detach; the daemon carries on.
+		if self._sock is not None:
+			try:
+				self._sock.shutdown(socket.SHUT_RDWR)
+			except OSError:
+				pass
+			self._sock.close()
+		if self.preview is not None:
+			self.preview.close()
+
+
+def parse_size(text):
+	width, height = text.lower().split('x')
+	return int(width), int(height)
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Run the rig without a GUI and publish results to viewers.")
+	parser.add_argument('--camera', help="camera, as in rigs.py, e.g. jetson:0 or sim:5; the platform's by default")
+	parser.add_argument('--port', type=int, default=PORT, help="localhost port viewers connect to")
+	parser.add_argument('--servo', help="servo controller serial port")
+	parser.add_argument('--log', default=LOG_PATH, help="roll log")
+	parser.add_argument('--preview', type=parse_size, default=PREVIEW_SIZE, metavar='WxH', help="preview frame size")
+	parser.add_argument('-w', '--workers', type=int, default=None, help="die matching workers")
+	parser.add_argument('--processes', action='store_true', help="match dice in worker processes instead of threads")
+	parser.add_argument('--keep-rolling', action='store_true', help="don't stop once every die is decided")
+	args = parser.parse_args(argv)
+	
+	cam = make_cam(args.camera) if args.camera else None
+	motion = sim.SimMotion(cam) if isinstance(cam, sim.SimCam) else Motion(args.servo)
+	vision = VisionThread(
+		name='vision', workers=args.workers, processes=args.processes, pipelined=True, cam=cam, motion=motion)
+	daemon = DiceDaemon(vision, args.log, HOST, args.port, args.preview, args.keep_rolling)
+	if not daemon.start():
+		return 1
+	print("Serving on {}:{:d}".format(HOST, args.port))
+	try:
+		while True:
+			daemon.poll()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		daemon.stop()
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -14,19 +14,29 @@
 ###############################################################################
 
 import math
+import queue
+import threading
+import time
 from enum import Enum
 
 import tkinter
 from tkinter import font
 from tkinter import W, E, N, S
 import cv2
+import numpy as np
 from PIL import Image, ImageTk
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
-from matplotlib.figure import Figure
 
 from vision import VisionThread
-from die import Die
+from die import Die, chi_squared_trace
+from session import Session
+from rolllog import RollLog, LOG_PATH
+from sequential import SequentialTest, VERDICTS
+import dietypes
+from history import SeriesHistory
 import graphs
+import perf
+import sim
 
 
 def clamp_aspect(ratio, width, height):
@@ -45,13 +55,34 @@ class DiceviewApp:
 	class States(Enum):
 		SAMPLE = 0
 		SAMPLE_WAIT = 1
-		SAMPLE_READY = 2
+		PAUSED = 2
 	
 	PADDING = 5
 	ROWMIN = 400
 	COLMIN = 800
 	
-	FACES = 20
+	# Die type shown in the graphs and stat tiles; every other type in the tray is still tracked by the session
+	DIE_TYPE = 'D20'
+	# Stages shown in the performance panel, in pipeline order
+	PERF_STAGES = ('roll', 'settle', 'capture', 'process', 'segment', 'match', 'die', 'redraw', 'show', 'cycle')
+	PERF_EXPORT = 'perf.json'
+	# Seconds between performance panel refreshes
+	PERF_REFRESH = 1.0
+	# Roll the next batch while the last frame is still being analysed
+	PIPELINED = True
+	# Stop rolling once every die in the tray is decided fair or biased, see SequentialTest. STOP_EFFECT is the
+	# smallest bias worth detecting, as Cohen's w, and STOP_ALPHA and STOP_BETA the error rates.
+	STOP_WHEN_DECIDED = True
+	STOP_EFFECT = 0.1
+	STOP_ALPHA = 0.05
+	STOP_BETA = 0.05
+	# Run on a simulated camera and shaker with this many dice in the tray instead of the rig, see sim.py. Simulated
+	# rolls go to their own log.
+	SIMULATE = 0
+	SIM_LOG = 'sim-rolls.log'
+	# Attach as a viewer to a daemon.py running the rig at this (host, port), instead of driving the rig from this
+	# process. The daemon keeps the roll log; this only reads it.
+	REMOTE = None
 	
 	def __init__(self):
 		self.root = tkinter.Tk()
@@ -77,9 +108,13 @@ class DiceviewApp:
 		self.graph_chi.grid(row=0, column=1, sticky=W + E + N + S, padx=self.PADDING, pady=self.PADDING)
 		self.graph_bar.pack_propagate(False)
 		self.graph_chi.pack_propagate(False)
-		self._nullfig = Figure()
-		self.canvas_bar = FigureCanvasTkAgg(self._nullfig, master=self.graph_bar)
-		self.canvas_chi = FigureCanvasTkAgg(self._nullfig, master=self.graph_chi)
+		die_type = dietypes.get(self.DIE_TYPE)
+		self.plot_bar = graphs.CountGraph(die_type.sides)
+		self.plot_chi = graphs.ChiGraph()
+		self.canvas_bar = FigureCanvasTkAgg(self.plot_bar.figure, master=self.graph_bar)
+		self.canvas_chi = FigureCanvasTkAgg(self.plot_chi.figure, master=self.graph_chi)
+		self.plot_bar.attach(self.canvas_bar)
+		self.plot_chi.attach(self.canvas_chi)
 		self.canvas_bar.get_tk_widget().pack(fill="both", expand=True)
 		self.canvas_chi.get_tk_widget().pack(fill="both", expand=True)
 		
@@ -94,15 +129,20 @@ class DiceviewApp:
 		self.statframe.grid(row=1, column=0, sticky=W + E + N + S, padx=self.PADDING, pady=self.PADDING)
 		self.statframe.rowconfigure(0, weight=1)
 		self.statframe.rowconfigure(1, weight=1)
+		self.statframe.rowconfigure(2, weight=0)
+		self.statframe.rowconfigure(3, weight=0)
 		self.statframe.columnconfigure(0, weight=1)
 		self.statframe.columnconfigure(1, weight=1)
+		self.statframe.columnconfigure(2, weight=1)
 		
 		self.lilfont = font.Font(family='Trebuchet MS', size=25, weight='normal')
 		self.bigfont = font.Font(family='Trebuchet MS', size=75, weight='bold')
+		self.perffont = font.Font(family='Courier', size=10, weight='normal')
 		
 		positions = {
 			"Actuations": (0, 0),
 			"Dice Rolls": (0, 1),
+			"Rejected": (0, 2),
 			"Average Roll": (1, 0),
 			"Chi-Squared": (1, 1)
 		}
@@ -124,33 +164,145 @@ class DiceviewApp:
 			self.sf_vars[pos].grid(row=1, column=0, sticky=W + E)
 			self.sf_vars[pos].grid_propagate(False)
 		
+		self.verdict_label = tkinter.Label(
+			self.statframe, text="", font=self.perffont, bg='#eee', justify=tkinter.LEFT, anchor=W)
+		self.verdict_label.grid(row=2, column=0, columnspan=3, sticky=W + E, padx=30)
+		self.perf_label = tkinter.Label(
+			self.statframe, text="", font=self.perffont, bg='#eee', fg='#555', justify=tkinter.LEFT, anchor=W)
+		self.perf_label.grid(row=3, column=0, columnspan=3, sticky=W + E, padx=30)
+		self._perf_shown = 0.0
+		
 		self.actuations = 0
-		self.chi_history = []
-		self.die = Die("D20", 20)
+		self.chi_history = SeriesHistory()
+		self.die = Die(die_type.name, die_type.sides)
+		self.test = SequentialTest(self.STOP_EFFECT, self.STOP_ALPHA, self.STOP_BETA)
+		self.session = Session(dietypes.active(), test=self.test)
+		self.stop_when_decided = self.STOP_WHEN_DECIDED
+		if self.REMOTE:
+			# Needs Python 3.8 for shared memory, so only imported when used
+			import daemon
+			self.vision = daemon.DaemonClient(*self.REMOTE)
+			if not self.vision.connect():
+				exit(1)
+			self.log = RollLog(self.vision.log_path)
+		elif self.SIMULATE:
+			cam = sim.SimCam(self.SIMULATE, self.DIE_TYPE)
+			self.vision = VisionThread(pipelined=self.PIPELINED, cam=cam, motion=sim.SimMotion(cam))
+			self.log = RollLog(self.SIM_LOG)
+		else:
+			self.vision = VisionThread(pipelined=self.PIPELINED)
+			self.log = RollLog(LOG_PATH)
+		self.resume()
 		
-		self.vision = VisionThread()
+		# Nothing runs on the Tk loop until the vision side has results, see _notify_loop()
+		self._wakeup = threading.Event()
+		self._handled = threading.Event()
+		self._closing = False
+		self._flush_due = False
+		self._notifier = threading.Thread(target=self._notify_loop, name='notify', daemon=True)
+		self.root.bind('<<Results>>', self.on_results)
+		self.vision.notify = self.wake
+		self._notifier.start()
 		self.vision.start()
 		
 		self.state = self.States.SAMPLE
-		self.root.after(1, self.tick)
+		# Dice may already be decided from the roll log
+		self.check_decided()
+		self.root.bind('<space>', self.keep_rolling)
+		# Also takes in anything that arrived before the Tk loop was running, and starts the rig
+		self.root.after(1, self.on_results)
+	
+	def wake(self):
+		# Called on the vision side whenever a result is ready. Never blocks, so a busy GUI can't hold up the rig.
+		self._wakeup.set()
+	
+	def _notify_loop(self):
+		# Posts a <<Results>> event to the Tk loop, then waits for it to be handled before posting another, so however
+		# many results arrive in between they are taken in together with a single redraw. event_generate() from
+		# outside the Tk thread waits for the Tk loop to service it, which is why it's called here and not by wake().
+		while True:
+			self._wakeup.wait()
+			if self._closing:
+				return
+			self._wakeup.clear()
+			self._handled.clear()
+			try:
+				self.root.event_generate('<<Results>>', when='tail')
+			except (tkinter.TclError, RuntimeError):
+				# The Tk loop isn't running yet
+				self._wakeup.set()
+				time.sleep(0.1)
+				continue
+			self._handled.wait()
+	
+	def on_results(self, event=None):
+		# Anything that comes in from here on needs another event
+		self._handled.set()
+		if self._closing:
+			return
+		if self.vision.pipelined:
+			self.drain()
+		else:
+			self.take_result()
+		self.sample()
 	
-	def tick(self):
+	def sample(self):
+		# Ask for the next roll, unless stopped or already rolling. In pipelined mode one call keeps the rig going.
 		if self.state == self.States.SAMPLE:
 			self.vision.sample()
 			self.state = self.States.SAMPLE_WAIT
+	
+	def take_result(self):
+		# Unpipelined mode: take the result of the last roll, if it is in.
+		with self.vision.reslock:
+			if not self.vision.fresh:
+				return
+		dice, frame = self.vision.wait_results()
 		if self.state == self.States.SAMPLE_WAIT:
-			with self.vision.reslock:
-				if self.vision.fresh:
-					self.state = self.States.SAMPLE_READY
-		if self.state == self.States.SAMPLE_READY:
-			dice, frame = self.vision.wait_results()
-			self.show_frame(frame)
-			self.update_stats(dice)
 			self.state = self.States.SAMPLE
-		
-		self.root.after(10, self.tick)
+		self.show_frame(frame)
+		# May pause
+		self.update_stats([dice])
+	
+	def drain(self):
+		# Pipelined mode: take every result waiting on the vision queue, and show only the newest frame.
+		batch = []
+		frame = None
+		while True:
+			try:
+				dice, frame = self.vision.results.get_nowait()
+			except queue.Empty:
+				break
+			batch.append(dice)
+		if batch:
+			self.update_stats(batch)
+		if frame is not None:
+			self.show_frame(frame)
+	
+	def schedule_flush(self):
+		# Catch up on graph redraws held back by the throttle, with one timer rather than polling.
+		if self._flush_due or not (self.plot_bar.pending or self.plot_chi.pending):
+			return
+		self._flush_due = True
+		self.root.after(int(graphs.REDRAW_INTERVAL * 1000) + 1, self.flush_graphs)
+	
+	def flush_graphs(self):
+		self._flush_due = False
+		self.plot_bar.flush()
+		self.plot_chi.flush()
+		self.schedule_flush()
+	
+	def show_perf(self):
+		# Per-stage p50/p95/max in ms, refreshed at most every PERF_REFRESH seconds.
+		now = time.monotonic()
+		if now - self._perf_shown < self.PERF_REFRESH:
+			return
+		self._perf_shown = now
+		text = perf.stages.format(self.PERF_STAGES)
+		self.perf_label.configure(text="{:<8} {:>7} {:>7} {:>7}\n".format("ms", "p50", "p95", "max") + text)
 	
 	def show_frame(self, frame):
+		start = time.perf_counter()
 		frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGBA)
 		size = clamp_aspect(16.0 / 9.0, self.tkimage.winfo_width(), self.tkimage.winfo_height())
 		frame = cv2.resize(frame, size)
@@ -158,34 +310,115 @@ class DiceviewApp:
 		frame = ImageTk.PhotoImage(frame)
 		self.tkimage.configure(image=frame)
 		self.tkimage.image = frame
+		perf.stages.record('show', time.perf_counter() - start)
 	
-	def update_stats(self, dice):
-		self.actuations += 1
-		for roll in dice:
-			self.die.add_roll(roll)
+	def update_stats(self, batch):
+		# Parameter batch holds the dice found in each actuation since the last update, oldest first.
+		with perf.stages.time('redraw'):
+			self._update_stats(batch)
+		self.show_perf()
+	
+	def _update_stats(self, batch):
+		for dice in batch:
+			ids = self.session.record(dice)
+			if not self.REMOTE:
+				self.log.append(self.actuations, dice, ids)
+			self.actuations += 1
+			self.die.add_rolls([det.value for det in dice if det.kind == self.die.name])
+			if self.die.rolls() > 0:
+				self.chi_history.append(self.die.chi_squared())
+		self.show_stats()
+		self.schedule_flush()
+		self.check_decided()
+	
+	def check_decided(self):
+		# Show each die's verdict and stop rolling once all of them are in.
+		store = self.session.store
+		if store.rows == 0:
+			return
+		verdicts = store.verdicts(self.test)
+		text = "   ".join("{}: {}".format(label, VERDICTS[int(v)]) for label, v in zip(store.labels(), verdicts))
+		pooled = sorted(self.session.tracker.pooled)
+		if pooled:
+			text += "\nSeveral {} dice in the tray, their rolls are pooled".format(", ".join(pooled))
+		if self.stop_when_decided and self.state != self.States.PAUSED:
+			if np.all(self.test.finished(verdicts, store.n[:store.rows])):
+				self.vision.pause()
+				self.state = self.States.PAUSED
+		if self.state == self.States.PAUSED:
+			text += "\nStopped, press space to keep rolling"
+		self.verdict_label.configure(text=text)
+	
+	def keep_rolling(self, event=None):
+		# Carry on past the stop rule, e.g. to tighten the estimates.
+		if self.state == self.States.PAUSED:
+			self.stop_when_decided = False
+			if self.REMOTE:
+				# The daemon has a stop rule of its own
+				self.vision.keep_rolling()
+			self.state = self.States.SAMPLE
+			self.check_decided()
+			self.sample()
+	
+	def resume(self):
+		# Replay the roll log from earlier runs into the statistics, all vectorised.
+		try:
+			rows = self.log.read() if self.REMOTE else self.log.open()
+		except OSError:
+			print("Couldn't open roll log!")
+			return
+		if self.REMOTE:
+			# Everything from here on comes from the daemon
+			self.actuations = self.vision.actuations
+			rows = rows[rows['actuation'] < self.actuations]
+		if len(rows) == 0:
+			return
 		
+		self.actuations = max(self.actuations, int(rows['actuation'].max()) + 1)
+		rows = rows[rows['die'] >= 0]
+		kinds = self.log.kind_names(rows)
+		self.session.replay(rows['die'], kinds, rows['value'], np.stack([rows['x'], rows['y']], axis=1))
+		
+		mine = rows[kinds == self.die.name]
+		if len(mine) > 0:
+			self.die.add_rolls(mine['value'])
+			# One chi-squared point per actuation from the first roll of this die on, as if added live
+			trace = chi_squared_trace(mine['value'], self.die.sides)
+			acts = np.arange(mine['actuation'][0], self.actuations)
+			self.chi_history.extend(trace[np.searchsorted(mine['actuation'], acts, side='right') - 1])
+		self.show_stats()
+	
+	def show_stats(self):
 		self.sf_vars["Actuations"].configure(text="{:d}".format(self.actuations))
+		# Dice left out of the statistics as too uncertain, since the rig started
+		self.sf_vars["Rejected"].configure(text="{:d}".format(self.vision.rejected))
 		if self.die.rolls() < 1:
 			return
 		
-		self.chi_history.append(self.die.chi_squared())
 		self.sf_vars["Dice Rolls"].configure(text="{:d}".format(self.die.rolls()))
 		self.sf_vars["Average Roll"].configure(text="{:2.2f}".format(self.die.average()))
-		self.sf_vars["Chi-Squared"].configure(text="{:2.2f}".format(self.chi_history[-1]))
+		self.sf_vars["Chi-Squared"].configure(text="{:2.2f}".format(self.chi_history.last))
 		
-		class FakeEvent:
-			def __init__(self, width, height):
-				self.width = width
-				self.height = height
-		self.canvas_chi.figure = graphs.chi_graph(self.chi_history)
-		self.canvas_chi.resize(FakeEvent(self.graph_chi.winfo_width(), self.graph_chi.winfo_height()))
-		self.canvas_bar.figure = graphs.count_graph(self.die)
-		self.canvas_bar.resize(FakeEvent(self.graph_bar.winfo_width(), self.graph_bar.winfo_height()))
+		self.plot_chi.update(*self.chi_history.data())
+		self.plot_bar.update(self.die.count)
 	
 	def shutdown(self):
-		self.root.destroy()
+		self._closing = True
+		self._wakeup.set()
+		self._handled.set()
 		self.vision.stop()
-		self.vision.join(timeout=10)
+		# Keep Tk going until the vision side and the notifier have stopped, as the notifier may be waiting on an
+		# event_generate()
+		deadline = time.monotonic() + 10
+		while (self.vision.is_alive() or self._notifier.is_alive()) and time.monotonic() < deadline:
+			self.root.update()
+			self.vision.join(timeout=0.05)
+		self.root.destroy()
+		self.log.close()
+		try:
+			perf.stages.export(self.PERF_EXPORT)
+		except OSError:
+			print("Couldn't export performance stats!")
 		exit(0)
 	
 	def run(self):
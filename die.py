@@ -13,28 +13,96 @@
 #
 ###############################################################################
 
+import math
+
 import numpy as np
 from scipy import stats
 
 
+def chi_squared_trace(rolls, sides, count=None):
+	# Chi-squared against a fair die after each roll of a sequence, vectorised. Each roll adds 2c + 1 to the sum of
+	# squared counts, where c is how often its face came up before; c is its rank among equal faces.
+	# Parameter count is the per-face count of earlier rolls to continue from, e.g. Die.count, by default none.
+	rolls = np.asarray(rolls, dtype=np.int64).ravel()
+	order = np.argsort(rolls, kind='stable')
+	ordered = rolls[order]
+	before = np.empty(len(rolls), dtype=np.int64)
+	before[order] = np.arange(len(rolls)) - np.searchsorted(ordered, ordered, side='left')
+	n = np.arange(1, len(rolls) + 1)
+	base = 0
+	if count is not None:
+		count = np.asarray(count, dtype=np.int64)
+		before += count[rolls - 1]
+		n += count.sum()
+		base = np.dot(count, count)
+	count_sq = base + np.cumsum(2 * before + 1)
+	return (sides * count_sq - n * n) / n
+
+
 class Die(object):
+	# Roll statistics kept as running totals: the number of rolls, the sum and sum of squares of the values, the
+	# per-face counts and the sum of squared counts. Everything below is O(1) to update per roll, and batches of rolls
+	# go in as one vectorised call.
 	def __init__(self, name, sides):
 		self.name = name
 		self.sides = sides
-		self.count = np.zeros(self.sides)
+		self.count = np.zeros(self.sides, dtype=np.int64)
+		self.n = 0
+		self.total = 0
+		self.total_sq = 0
+		# Sum of squared face counts, for chi-squared. Python ints so very long runs can't overflow.
+		self._count_sq = 0
 	
 	def add_roll(self, roll):
-		self.count[roll - 1] += 1
+		c = int(self.count[roll - 1])
+		self.count[roll - 1] = c + 1
+		self._count_sq += 2 * c + 1
+		self.n += 1
+		self.total += roll
+		self.total_sq += roll * roll
+	
+	def add_rolls(self, rolls):
+		# Add any number of rolls at once. Parameter rolls is a sequence or numpy array of face values.
+		rolls = np.asarray(rolls, dtype=np.int64).ravel()
+		if len(rolls) == 0:
+			return
+		if rolls.min() < 1 or rolls.max() > self.sides:
+			raise ValueError("roll out of range for {}".format(self.name))
+		self.count += np.bincount(rolls - 1, minlength=self.sides)
+		self._count_sq = sum(int(c) * int(c) for c in self.count)
+		self.n += len(rolls)
+		self.total += int(rolls.sum())
+		self.total_sq += int(np.dot(rolls, rolls))
 	
 	def average(self):
-		rollsum = 0
-		for side in range(self.sides):
-			rollsum += (side + 1) * self.count[side]
-		return rollsum / np.sum(self.count)
+		if self.n == 0:
+			return float('nan')
+		return self.total / self.n
+	
+	def variance(self):
+		if self.n == 0:
+			return float('nan')
+		mean = self.total / self.n
+		return self.total_sq / self.n - mean * mean
 	
 	def rolls(self):
-		return int(np.sum(self.count))
+		return self.n
 	
 	def chi_squared(self):
-		# should calculated the chi squared of the count array
-		return stats.chisquare(self.count)[0]
+		# Pearson's chi-squared against a fair die: sum((c - n/k)^2 / (n/k)) = k * sum(c^2) / n - n
+		if self.n == 0:
+			return float('nan')
+		return (self.sides * self._count_sq - self.n * self.n) / self.n
+	
+	def p_value(self):
+		# Probability of a chi-squared at least this large from a fair die.
+		if self.n == 0:
+			return float('nan')
+		return float(stats.chi2.sf(self.chi_squared(), self.sides - 1))
+	
+	def z_scores(self):
+		# Standardised deviation of each face count from a fair die.
+		if self.n == 0:
+			return np.zeros(self.sides)
+		p = 1.0 / self.sides
+		return (self.count - self.n * p) / math.sqrt(self.n * p * (1 - p))
@@ -0,0 +1,114 @@
+###############################################################################
+# Project: Polyhedral Dice Statistical Analysis (Diceview)
+# File   : dietypes.py
+#
+# Registry of die types and their reference images.
+#
+# Copyright (c) 2020 Diceview Team
+# Released under the MIT License.
+#
+#   Date      SCR  Comment                                        Eng
+# -----------------------------------------------------------------------------
+#   20261017       Created                                        agent
+#
+###############################################################################
+
+import glob
+import os
+import re
+from collections import OrderedDict
+
+
+REF_DIR = 'refim'
+# Subdirectory of a type's references holding extra example images per face, e.g. relabelled crops from review
+EXTRA_DIR = 'extra'
+
+
+class DieType(object):
+	# A kind of die, e.g. D6, and where its reference face images live. Faces are numbered 1..sides and stored as
+	# <path>/<face>-Grey.jpg, with any further examples of a face as <path>/extra/<face>-<tag>.jpg.
+	def __init__(self, name, sides, path):
+		self.name = name
+		self.sides = sides
+		self.path = path
+	
+	def __repr__(self):
+		return "DieType({!r}, {:d}, {!r})".format(self.name, self.sides, self.path)
+	
+	def face_path(self, face):
+		return os.path.join(self.path, '{}-Grey.jpg'.format(face))
+	
+	def key(self, face):
+		# Reference library key for one face of this type.
+		return '{}:{}'.format(self.name, face)
+	
+	def extra_paths(self, face):
+		return sorted(glob.glob(os.path.join(self.path, EXTRA_DIR, '{}-*.jpg'.format(face))))
+	
+	def sources(self):
+		# Every reference image of this type, as face key -> path. Extra images get keys of the form 'type:face+tag',
+		# which base_key and parse_key reduce to the face.
+		out = OrderedDict()
+		for face in range(1, self.sides + 1):
+			out[self.key(face)] = self.face_path(face)
+			for path in self.extra_paths(face):
+				tag = os.path.splitext(os.path.basename(path))[0].split('-', 1)[1]
+				out['{}+{}'.format(self.key(face), tag)] = path
+		return out
+	
+	def complete(self):
+		return all(os.path.isfile(self.face_path(face)) for face in range(1, self.sides + 1))
+
+
+def base_key(key):
+	# Face key of a reference image key, dropping any extra image tag.
+	return key.split('+', 1)[0]
+
+
+def parse_key(key):
+	# Split a reference library key into the die type name and the face value.
+	name, face = base_key(key).rsplit(':', 1)
+	return name, int(face)
+
+
+registry = OrderedDict()
+_discovered = False
+
+
+def register(name, sides, path):
+	registry[name] = DieType(name, sides, path)
+	return registry[name]
+
+
+def get(name):
+	return registry[name]
+
+
+def discover(root=REF_DIR):
+	# Register every reference set found under root. A directory named d<sides>, optionally followed by - or _ and a
+	# tag (d6, d6-red, d10_percentile), holds one die type. Types already registered are left alone.
+	global _discovered
+	_discovered = True
+	try:
+		entries = sorted(os.listdir(root))
+	except OSError:
+		return
+	for entry in entries:
+		m = re.match(r'[dD](\d+)(?:[-_]\w+)?$', entry)
+		path = os.path.join(root, entry)
+		if m is None or not os.path.isdir(path):
+			continue
+		name = entry.upper()
+		if name not in registry:
+			register(name, int(m.group(1)), path)
+
+
+def active():
+	# Every registered type with a full set of reference images.
+	if not _discovered:
+		discover()
+	return [t for t in registry.values() if t.complete()]
+
+
+# The original D20 reference set lives directly in refim/
+register('D20', 20, REF_DIR)
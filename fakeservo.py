@@ -0,0 +1,115 @@
+###############################################################################
+# Project: Polyhedral Dice Statistical Analysis (Diceview)
+# File   : fakeservo.py
+#
+# Stand-in for the servo controller on a pseudo-terminal.
+#
+# Copyright (c) 2020 Diceview Team
+# Released under the MIT License.
+#
+#   Date      SCR  Comment                                        Eng
+# -----------------------------------------------------------------------------
+#   20261017       Created                                        agent
+#
+###############################################################################
+
+import os
+import select
+import threading
+import time
+import tty
+
+
+class FakeController(object):
+	# Behaves like servo/servo.ino on the slave end of a pty, whose path is self.port: a letter command followed by an
+	# integer, answered with a newline. s sets the angle, l and u the minimum and maximum pulse widths. Every command
+	# is kept in self.log as (time, letter, value). Set ack_delay to slow acknowledgements down, or mute to stop them.
+	def __init__(self, ack_delay=0.0):
+		self.ack_delay = ack_delay
+		self.mute = False
+		self.angle = 170
+		self.smin = 899
+		self.smax = 2077
+		self.log = []
+		self._master = None
+		self._slave = None
+		self._thread = None
+		self._running = False
+		self.port = None
+	
+	def __enter__(self):
+		self.start()
+		return self
+	
+	def __exit__(self, *exc):
+		self.stop()
+	
+	def start(self):
+		self._master, self._slave = os.openpty()
+		# No echo or newline translation, like a real serial port
+		tty.setraw(self._slave)
+		self.port = os.ttyname(self._slave)
+		self._running = True
+		self._thread = threading.Thread(target=self._run, name='fakeservo')
+		self._thread.daemon = True
+		self._thread.start()
+	
+	def stop(self):
+		self._running = False
+		if self._thread is not None:
+			self._thread.join()
+			self._thread = None
+		for fd in (self._master, self._slave):
+			if fd is not None:
+				os.close(fd)
+		self._master = self._slave = None
+	
+	def _execute(self, letter, value):
+		self.log.append((time.monotonic(), letter, value))
+		if letter == 's':
+			self.angle = value
+		elif letter == 'l':
+			self.smin = value
+		elif letter == 'u':
+			self.smax = value
+		else:
+			return
+		if self.ack_delay > 0.0:
+			time.sleep(self.ack_delay)
+		if not self.mute:
+			os.write(self._master, b'\n')
+	
+	def _run(self):
+		letter = None
+		digits = ''
+		while self._running:
+			ready, _, _ = select.select([self._master], [], [], 0.1)
+			if not ready:
+				continue
+			try:
+				data = os.read(self._master, 256).decode('ascii', 'replace')
+			except OSError:
+				# Nothing has the slave end open
+				time.sleep(0.01)
+				continue
+			for c in data:
+				if letter is None:
+					if c.isalpha():
+						letter = c
+				elif c.isdigit() or (c == '-' and not digits):
+					digits += c
+				elif digits not in ('', '-'):
+					# First character after the number ends it, as with Serial.parseInt
+					self._execute(letter, int(digits))
+					letter = None
+					digits = ''
+
+
+if __name__ == '__main__':
+	with FakeController() as fake:
+		print("Fake servo controller on {}".format(fake.port))
+		try:
+			while True:
+				time.sleep(1.0)
+		except KeyboardInterrupt:
+			pass
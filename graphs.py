@@ -13,11 +13,17 @@
 #
 ###############################################################################
 
+import time
+
 from matplotlib.figure import Figure
 import matplotlib.ticker as tick
 import numpy as np
 
 
+# Minimum seconds between redraws of a live graph
+REDRAW_INTERVAL = 0.2
+
+
 def count_graph(die):
 	# Return a plot object which is a bar graph of how many times each face was rolled, autoscaled to the min/max of
 	# the data + 10% on either side.
@@ -61,3 +67,142 @@ def chi_graph(chi_values):
 	graph.set_xlabel("Time")
 	
 	return fig
+
+
+class LiveGraph(object):
+	# A persistent figure whose data artists are updated in place. The axes are only redrawn in full when their limits
+	# change or the canvas is resized; otherwise the cached axes background is restored and only the data artists are
+	# blitted over it. Redraws are throttled to REDRAW_INTERVAL, call flush() periodically to catch up.
+	def __init__(self):
+		self.figure = Figure()
+		self.graph = self.figure.add_subplot(111)
+		self.figure.subplots_adjust(left=0.1, right=0.9, top=0.9, bottom=0.1)
+		self.canvas = None
+		self.artists = []
+		self._background = None
+		self._stale_axes = True
+		self._pending = False
+		self._last_draw = 0.0
+	
+	def attach(self, canvas):
+		# Parameter canvas is a FigureCanvas, e.g. FigureCanvasTkAgg, showing this graph's figure.
+		self.canvas = canvas
+		canvas.figure = self.figure
+		self.figure.set_canvas(canvas)
+		canvas.mpl_connect('draw_event', self._on_draw)
+	
+	def _on_draw(self, event):
+		# Full draws skip the animated data artists, so grab the background and draw them on top.
+		self._background = self.canvas.copy_from_bbox(self.graph.bbox)
+		self._draw_artists()
+	
+	def _draw_artists(self):
+		for artist in self.artists:
+			self.graph.draw_artist(artist)
+	
+	def _animate(self, artists):
+		for artist in artists:
+			artist.set_animated(True)
+		self.artists.extend(artists)
+	
+	@property
+	def pending(self):
+		# Whether a redraw is being held back by the throttle.
+		return self._pending
+	
+	def redraw(self):
+		self._pending = True
+		self.flush()
+	
+	def flush(self):
+		if not self._pending or self.canvas is None:
+			return
+		now = time.monotonic()
+		if now - self._last_draw < REDRAW_INTERVAL:
+			return
+		self._last_draw = now
+		self._pending = False
+		
+		if self._stale_axes or self._background is None:
+			self._stale_axes = False
+			self.canvas.draw_idle()
+		else:
+			self.canvas.restore_region(self._background)
+			self._draw_artists()
+			self.canvas.blit(self.graph.bbox)
+	
+	def _set_ylim(self, lo, hi):
+		if (lo, hi) != tuple(self.graph.get_ylim()):
+			self.graph.set_ylim([lo, hi])
+			self._stale_axes = True
+	
+	def _set_xlim(self, lo, hi):
+		if (lo, hi) != tuple(self.graph.get_xlim()):
+			self.graph.set_xlim([lo, hi])
+			self._stale_axes = True
+
+
+class CountGraph(LiveGraph):
+	# Live version of count_graph. Bar heights are updated in place, and the y axis only rescales when a count leaves
+	# the current limits or the limits become more than twice as wide as they need to be.
+	def __init__(self, sides):
+		super(CountGraph, self).__init__()
+		self.sides = sides
+		bars = self.graph.bar(range(sides), np.zeros(sides))
+		self.bars = list(bars)
+		self._animate(self.bars)
+		
+		self.graph.set_xticks(range(sides))
+		self.graph.xaxis.set_major_formatter(tick.FuncFormatter(lambda x, y: "{:d}".format(int(x + 1))))
+		self.graph.set_ylim([0, 10])
+		
+		self.graph.set_title("Dice Roll Count per Face")
+		self.graph.set_ylabel("Rolls")
+		self.graph.set_xlabel("Face")
+	
+	def update(self, count):
+		for bar, height in zip(self.bars, count):
+			bar.set_height(height)
+		
+		lo, hi = self.graph.get_ylim()
+		maxc = np.max(count)
+		minc = np.min(count)
+		rangec = maxc - minc
+		want_hi = np.max([maxc + rangec / 5, 10])
+		want_lo = np.max([minc - rangec / 5, 0])
+		if minc < lo or maxc > hi or (hi - lo) > 2 * (want_hi - want_lo):
+			self._set_ylim(float(want_lo), float(want_hi))
+		self.redraw()
+
+
+class ChiGraph(LiveGraph):
+	# Live version of chi_graph. The line's data is replaced in place, and the axes grow in steps rather than on every
+	# new point so most updates are a blit.
+	def __init__(self):
+		super(ChiGraph, self).__init__()
+		self.line, = self.graph.plot([], [])
+		self._animate([self.line])
+		
+		self.graph.tick_params(axis='x', which='both', bottom=False, top=False, labelbottom=False)
+		self.graph.set_xlim([0, 1])
+		self.graph.set_ylim([0, 1])
+		
+		self.graph.set_title("Chi-Squared of Roll Frequency over Time")
+		self.graph.set_ylabel("Chi-Squared")
+		self.graph.set_xlabel("Time")
+	
+	def update(self, x, y):
+		# Parameters x and y are the sample positions and chi-squared values to show.
+		if len(y) == 0:
+			return
+		self.line.set_data(x, y)
+		
+		lo, hi = self.graph.get_xlim()
+		if x[-1] > hi or x[0] < lo:
+			self._set_xlim(float(x[0]), float(x[0] + (x[-1] - x[0]) * 1.5 + 1))
+		
+		lo, hi = self.graph.get_ylim()
+		maxy = float(np.max(y))
+		if maxy > hi or maxy * 1.25 < hi * 0.5:
+			self._set_ylim(0.0, maxy * 1.25 if maxy > 0 else 1.0)
+		self.redraw()
@@ -0,0 +1,153 @@
+###############################################################################
+# Project: Polyhedral Dice Statistical Analysis (Diceview)
+# File   : history.py
+#
+# Fixed-memory, downsampled history of a value over time.
+#
+# Copyright (c) 2020 Diceview Team
+# Released under the MIT License.
+#
+#   Date      SCR  Comment                                        Eng
+# -----------------------------------------------------------------------------
+#   20261017       Created                                        agent
+#
+###############################################################################
+
+import numpy as np
+
+
+def _extremes(x, y):
+	# Lowest and highest of a run of points, in time order. Always two points, the same one twice if need be.
+	if len(x) == 0:
+		return x, y
+	i = int(y.argmin())
+	j = int(y.argmax())
+	idx = [min(i, j), max(i, j)]
+	return x[idx], y[idx]
+
+
+def _buckets(x, y):
+	# Parameters x and y are (buckets, points) arrays. Each row is replaced by its lowest and highest point, in time
+	# order, giving flat arrays of two points per bucket.
+	rows = np.arange(len(y))
+	imin = y.argmin(axis=1)
+	imax = y.argmax(axis=1)
+	first = np.minimum(imin, imax)
+	second = np.maximum(imin, imax)
+	return (np.stack([x[rows, first], x[rows, second]], axis=1).ravel(),
+		np.stack([y[rows, first], y[rows, second]], axis=1).ravel())
+
+
+class SeriesHistory(object):
+	# Keeps at most capacity (x, y) points in preallocated arrays, however many are appended. The newest keep points
+	# are always at full resolution. Everything older is min/max bucketed at one resolution across the whole series:
+	# each bucket of width consecutive values is stored as its lowest and highest point, in time order. When the
+	# buckets outgrow their share of the arrays, adjacent pairs are merged and width doubles, so every stretch of the
+	# run keeps the same number of points and peaks and troughs survive anywhere in it.
+	def __init__(self, capacity=2048, keep=512):
+		if keep > capacity // 2:
+			raise ValueError("keep must be at most half of capacity")
+		self.capacity = capacity
+		self.keep = keep
+		# Bucketed points come first in the arrays, then the values not yet bucketed
+		self._x = np.zeros(capacity, dtype=np.float64)
+		self._y = np.zeros(capacity, dtype=np.float64)
+		self._n = 0
+		self._bucketed = 0
+		self.width = 2
+		# The newest bucket, still filling: its extreme points and how many values it holds so far
+		self._open_x = np.zeros(0, dtype=np.float64)
+		self._open_y = np.zeros(0, dtype=np.float64)
+		self._open_count = 0
+		# Total values appended, not the number stored
+		self.count = 0
+		self.last = None
+	
+	def __len__(self):
+		return self.count
+	
+	def append(self, y, x=None):
+		# Parameter x defaults to the number of values appended before this one.
+		if self._n == self.capacity:
+			self._compact()
+		self._x[self._n] = self.count if x is None else x
+		self._y[self._n] = y
+		self._n += 1
+		self.count += 1
+		self.last = y
+	
+	def extend(self, ys):
+		# Append many values at once, equivalent to calling append for each with the default x.
+		ys = np.asarray(ys, dtype=np.float64).ravel()
+		if len(ys) == 0:
+			return
+		xs = self.count + np.arange(len(ys), dtype=np.float64)
+		i = 0
+		while i < len(ys):
+			if self._n == self.capacity:
+				self._compact()
+			take = min(self.capacity - self._n, len(ys) - i)
+			self._x[self._n:self._n + take] = xs[i:i + take]
+			self._y[self._n:self._n + take] = ys[i:i + take]
+			self._n += take
+			i += take
+		self.count += len(ys)
+		self.last = float(ys[-1])
+	
+	def _fill_open(self, x, y):
+		self._open_x, self._open_y = _extremes(np.concatenate([self._open_x, x]), np.concatenate([self._open_y, y]))
+		self._open_count += len(x)
+	
+	def _compact(self):
+		# Bucket everything but the newest keep values, then merge buckets until they fit their share of the arrays.
+		old_x = [self._x[:self._bucketed]]
+		old_y = [self._y[:self._bucketed]]
+		fold_x = self._x[self._bucketed:self._n - self.keep]
+		fold_y = self._y[self._bucketed:self._n - self.keep]
+		
+		head = min(self.width - self._open_count, len(fold_x))
+		self._fill_open(fold_x[:head], fold_y[:head])
+		fold_x = fold_x[head:]
+		fold_y = fold_y[head:]
+		if self._open_count == self.width:
+			old_x.append(self._open_x)
+			old_y.append(self._open_y)
+			self._open_x = self._open_y = np.zeros(0, dtype=np.float64)
+			self._open_count = 0
+			whole = len(fold_x) // self.width * self.width
+			bx, by = _buckets(fold_x[:whole].reshape(-1, self.width), fold_y[:whole].reshape(-1, self.width))
+			old_x.append(bx)
+			old_y.append(by)
+			self._fill_open(fold_x[whole:], fold_y[whole:])
+		old_x = np.concatenate(old_x)
+		old_y = np.concatenate(old_y)
+		
+		while len(old_x) > (self.capacity - self.keep) // 2:
+			old_x, old_y = self._merge(old_x, old_y)
+		
+		bucketed = len(old_x)
+		recent_x = self._x[self._n - self.keep:self._n].copy()
+		recent_y = self._y[self._n - self.keep:self._n].copy()
+		self._x[:bucketed] = old_x
+		self._y[:bucketed] = old_y
+		self._x[bucketed:bucketed + self.keep] = recent_x
+		self._y[bucketed:bucketed + self.keep] = recent_y
+		self._bucketed = bucketed
+		self._n = bucketed + self.keep
+	
+	def _merge(self, x, y):
+		# Halve the resolution of the bucketed points, two points per bucket. With an odd number of buckets the last
+		# one joins the open bucket, which is newer and holds fewer values than a bucket of the new width.
+		if len(x) % 4:
+			self._open_x, self._open_y = _extremes(
+				np.concatenate([x[-2:], self._open_x]), np.concatenate([y[-2:], self._open_y]))
+			self._open_count += self.width
+			x = x[:-2]
+			y = y[:-2]
+		self.width *= 2
+		return _buckets(x.reshape(-1, 4), y.reshape(-1, 4))
+	
+	def data(self):
+		# Copies of the stored x and y values, oldest first.
+		return (np.concatenate([self._x[:self._bucketed], self._open_x, self._x[self._bucketed:self._n]]),
+			np.concatenate([self._y[:self._bucketed], self._open_y, self._y[self._bucketed:self._n]]))
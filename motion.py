@@ -13,34 +13,185 @@
 #
 ###############################################################################
 
+import queue
+import threading
 import time
+
 import serial
 
-class Motion(object):
-	def __init__(self):
-		# Set up connection to controller.
-		self.ser = None
+import perf
+
+
+PORT = '/dev/ttyACM0'
+BAUD = 115200
+
+
+class Command(object):
+	# One queued controller command, e.g. 's170'. The driver thread fills in the result; wait() blocks until it has.
+	def __init__(self, text, hold=0.0):
+		self.text = text
+		# Seconds the driver pauses after this command before sending the next, e.g. while the servo travels
+		self.hold = hold
+		self.acked = False
+		self.latency = None
+		self._done = threading.Event()
+	
+	def done(self):
+		return self._done.is_set()
+	
+	def wait(self, timeout=None):
+		# Returns whether the controller acknowledged the command.
+		self._done.wait(timeout)
+		return self.acked
+	
+	def _finish(self, acked, latency=None):
+		self.acked = acked
+		self.latency = latency
+		self._done.set()
+
+
+class MotionDriver(object):
+	# Talks to servo/servo.ino from a dedicated thread, so nothing else ever blocks on the serial port. Commands are
+	# queued and sent one at a time; each waits up to ack_timeout for the controller's newline acknowledgement, and the
+	# round trip is recorded per command letter in self.latency. The port is opened on the driver thread too, and
+	# commands queued while it is closed finish straight away unacknowledged.
+	def __init__(self, port=PORT, baud=BAUD, ack_timeout=0.5):
+		self.port = port
+		self.baud = baud
+		self.ack_timeout = ack_timeout
+		self.latency = perf.Perf()
+		self.sent = 0
+		self.timeouts = 0
+		self._ser = None
+		self._queue = queue.Queue()
+		self._opened = threading.Event()
+		self._thread = None
+	
+	def start(self):
+		if self._thread is None:
+			self._thread = threading.Thread(target=self._run, name='motion')
+			self._thread.daemon = True
+			self._thread.start()
+	
+	def stop(self):
+		if self._thread is not None:
+			self._queue.put(None)
+			self._thread.join()
+			self._thread = None
+	
+	def online(self, timeout=None):
+		# Whether the port is open, waiting for the attempt to open it if that hasn't finished yet.
+		self._opened.wait(timeout)
+		return self._ser is not None
+	
+	def send(self, text, hold=0.0):
+		# Queue a command and return its Command without waiting.
+		cmd = Command(text, hold)
+		self._queue.put(cmd)
+		return cmd
+	
+	def set_angle(self, angle, hold=0.0):
+		return self.send('s{:d}'.format(int(angle)), hold)
+	
+	def set_min(self, pulse):
+		# Servo pulse width in microseconds at angle 0.
+		return self.send('l{:d}'.format(int(pulse)))
+	
+	def set_max(self, pulse):
+		# Servo pulse width in microseconds at angle 180.
+		return self.send('u{:d}'.format(int(pulse)))
+	
+	def pending(self):
+		return self._queue.qsize()
+	
+	def _open(self):
 		try:
-			self.ser = serial.Serial('/dev/ttyACM0', 115200)
+			self._ser = serial.Serial(self.port, self.baud, timeout=self.ack_timeout)
+			# Opening the port resets the Arduino, and it drops anything sent before it has booted
 			time.sleep(0.1)
-			self.ser.write('s170\r\n'.encode())
-			self.ser.flush()
 		except serial.serialutil.SerialException:
-			self.ser = None
+			self._ser = None
 			print("Couldn't open serial comms to servo controller!")
+		self._opened.set()
+	
+	def _run(self):
+		self._open()
+		while True:
+			cmd = self._queue.get()
+			if cmd is None:
+				break
+			if self._ser is None:
+				cmd._finish(False)
+				continue
+			
+			start = time.perf_counter()
+			try:
+				self._ser.reset_input_buffer()
+				self._ser.write((cmd.text + '\r\n').encode())
+				self._ser.flush()
+				acked = self._ser.read_until(b'\n').endswith(b'\n')
+			except serial.serialutil.SerialException:
+				acked = False
+			latency = time.perf_counter() - start
+			
+			self.sent += 1
+			if acked:
+				self.latency.record(cmd.text[:1], latency)
+			else:
+				self.timeouts += 1
+			cmd._finish(acked, latency)
+			if cmd.hold > 0.0:
+				time.sleep(cmd.hold)
+		
+		if self._ser is not None:
+			self._ser.close()
+			self._ser = None
+	
+	def stats(self):
+		# Acknowledgement latency by command letter, plus counts of commands sent and unacknowledged.
+		return {'sent': self.sent, 'timeouts': self.timeouts, 'latency': self.latency.summary()}
+
+
+class Motion(object):
+	# Seconds for the servo to swing the tray over and tip the dice
+	TRAVEL = 1.0
+	# Seconds to wait for the controller's acknowledgement of a command
+	ACK_TIMEOUT = 0.5
+	# Servo angles with the tray tipped and at rest
+	TIPPED = 0
+	REST = 170
+	
+	def __init__(self, port=None):
+		# Set up connection to controller. This doesn't wait for the port to open. Parameter port defaults to PORT,
+		# looked up when called so it can be pointed elsewhere, e.g. at a fakeservo.FakeController.
+		self.driver = MotionDriver(port or PORT, ack_timeout=self.ACK_TIMEOUT)
+		self.driver.start()
+		self.driver.set_angle(self.REST)
+	
+	def command(self, cmd):
+		# Send one command and wait for the controller's newline acknowledgement. Returns False if none came.
+		return self.driver.send(cmd).wait()
+	
+	def start_actuate(self):
+		# Queue a tip of the tray and its return, and return at once with both Commands. Actuation is over once the
+		# second is done.
+		return self.driver.set_angle(self.TIPPED, hold=self.TRAVEL), self.driver.set_angle(self.REST)
+	
+	def actuate(self):
+		# Tip the tray and bring it back, returning as soon as the return command is acknowledged. Doesn't wait for
+		# the dice to stop; that's up to the caller, see vision.SettleDetector.
+		if self.driver.online():
+			tip, back = self.start_actuate()
+			if not (back.wait() and tip.acked):
+				print("Servo controller didn't acknowledge!")
 	
 	def roll(self):
 		# Block until dice roll actuation is complete.
-		if self.ser is not None:
+		if self.driver.online():
 			time.sleep(0.5)
-			self.ser.write('s0\r\n'.encode())
-			self.ser.flush()
-			time.sleep(1)
-			self.ser.write('s170\r\n'.encode())
-			self.ser.flush()
+			self.actuate()
 		else:
 			time.sleep(0.5)
 	
-	def __del__(self):
-		if self.ser is not None:
-			self.ser.close()
+	def close(self):
+		self.driver.stop()
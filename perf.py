@@ -0,0 +1,97 @@
+###############################################################################
+# Project: Polyhedral Dice Statistical Analysis (Diceview)
+# File   : perf.py
+#
+# Lightweight always-on timing of pipeline stages.
+#
+# Copyright (c) 2020 Diceview Team
+# Released under the MIT License.
+#
+#   Date      SCR  Comment                                        Eng
+# -----------------------------------------------------------------------------
+#   20261017       Created                                        agent
+#
+###############################################################################
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class StageTimer(object):
+	# Fixed-size ring of the most recent durations of one stage, in seconds. Recording is a lock and a store, so it
+	# can stay on in production. Percentiles are only computed when asked for.
+	def __init__(self, size=1024):
+		self._buf = np.zeros(size, dtype=np.float64)
+		self._lock = threading.Lock()
+		self._next = 0
+		self.count = 0
+		self.last = 0.0
+	
+	def record(self, seconds):
+		with self._lock:
+			self._buf[self._next] = seconds
+			self._next = (self._next + 1) % len(self._buf)
+			self.count += 1
+			self.last = seconds
+	
+	def stats(self):
+		# Returns p50, p95 and max in seconds over the buffered window, plus the total number recorded.
+		with self._lock:
+			window = self._buf[:min(self.count, len(self._buf))].copy()
+		if len(window) == 0:
+			return {'count': 0, 'p50': 0.0, 'p95': 0.0, 'max': 0.0}
+		p50, p95 = np.percentile(window, [50, 95])
+		return {'count': self.count, 'p50': float(p50), 'p95': float(p95), 'max': float(window.max())}
+
+
+class Perf(object):
+	# Named stage timers, created on first use.
+	def __init__(self, size=1024):
+		self.size = size
+		self.timers = dict()
+		self._lock = threading.Lock()
+	
+	def timer(self, name):
+		timer = self.timers.get(name)
+		if timer is None:
+			with self._lock:
+				timer = self.timers.setdefault(name, StageTimer(self.size))
+		return timer
+	
+	def record(self, name, seconds):
+		self.timer(name).record(seconds)
+	
+	@contextmanager
+	def time(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.record(name, time.perf_counter() - start)
+	
+	def summary(self):
+		return {name: timer.stats() for name, timer in list(self.timers.items())}
+	
+	def format(self, names=None):
+		# One line per stage, in milliseconds.
+		lines = []
+		summary = self.summary()
+		for name in (names or sorted(summary)):
+			s = summary.get(name)
+			if s is None or s['count'] == 0:
+				continue
+			lines.append("{:<8} {:7.1f} {:7.1f} {:7.1f}".format(
+				name, 1000.0 * s['p50'], 1000.0 * s['p95'], 1000.0 * s['max']))
+		return "\n".join(lines)
+	
+	def export(self, path):
+		with open(path, 'w') as f:
+			json.dump({'created': time.strftime('%Y-%m-%d %H:%M:%S'), 'stages': self.summary()}, f, indent=1)
+
+
+# Shared by every stage of the rig
+stages = Perf()
@@ -0,0 +1,151 @@
+###############################################################################
+# Project: Polyhedral Dice Statistical Analysis (Diceview)
+# File   : refindex.py
+#
+# Persistent on-disk index of reference face features.
+#
+# Copyright (c) 2020 Diceview Team
+# Released under the MIT License.
+#
+#   Date      SCR  Comment                                        Eng
+# -----------------------------------------------------------------------------
+#   20261017       Created                                        agent
+#
+###############################################################################
+
+import hashlib
+import json
+import os
+
+import cv2
+import numpy as np
+
+
+INDEX_DIR = os.path.join('refim', 'index')
+INDEX_VERSION = 1
+
+# Columns of the stored keypoint array.
+KP_X, KP_Y, KP_SIZE, KP_ANGLE, KP_RESPONSE, KP_OCTAVE = range(6)
+KP_COLUMNS = 6
+
+
+def file_hash(path):
+	h = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for chunk in iter(lambda: f.read(1 << 16), b''):
+			h.update(chunk)
+	return h.hexdigest()
+
+
+def keypoints_to_array(kp):
+	rows = [(k.pt[0], k.pt[1], k.size, k.angle, k.response, k.octave) for k in kp]
+	return np.array(rows, dtype=np.float32).reshape(-1, KP_COLUMNS)
+
+
+class ReferenceIndex(object):
+	# Keypoints and descriptors of every reference face, stacked into single arrays. Rows belonging to one face are
+	# contiguous, offsets gives the row range of each face and labels gives the face of each row. The arrays are
+	# saved as .npy files alongside a manifest of source image hashes, and memory mapped back in on the next start.
+	def __init__(self, name, path=INDEX_DIR):
+		self.name = name
+		self.path = os.path.join(path, name)
+		self.keys = []
+		self.keypoints = None
+		self.descriptors = None
+		self.labels = None
+		self.offsets = None
+	
+	def __len__(self):
+		return len(self.keys)
+	
+	def _file(self, name):
+		return os.path.join(self.path, name)
+	
+	def face(self, key):
+		# Keypoints and descriptors for a single face.
+		i = self.keys.index(key)
+		start, end = self.offsets[i], self.offsets[i + 1]
+		return self.keypoints[start:end], self.descriptors[start:end]
+	
+	def _set(self, keys, keypoints, descriptors, offsets):
+		self.keys = list(keys)
+		self.keypoints = keypoints
+		self.descriptors = descriptors
+		self.offsets = offsets
+		self.labels = np.repeat(np.arange(len(self.keys), dtype=np.int32), np.diff(offsets))
+	
+	def load(self, sources):
+		# Map in the saved index if it was built from exactly these source images.
+		# Parameter sources is an ordered dict of face key -> image path.
+		# Returns False if the index is missing or stale.
+		try:
+			with open(self._file('manifest.json')) as f:
+				manifest = json.load(f)
+		except (OSError, ValueError):
+			return False
+		
+		if manifest.get('version') != INDEX_VERSION or manifest.get('keys') != list(sources):
+			return False
+		for key, src in sources.items():
+			if manifest['hashes'].get(key) != file_hash(src):
+				return False
+		
+		try:
+			# Copy-on-write so OpenCV gets writeable arrays without touching the files.
+			keypoints = np.load(self._file('keypoints.npy'), mmap_mode='c')
+			descriptors = np.load(self._file('descriptors.npy'), mmap_mode='c')
+			offsets = np.load(self._file('offsets.npy'))
+		except (OSError, ValueError):
+			return False
+		
+		self._set(manifest['keys'], keypoints, descriptors, offsets)
+		return True
+	
+	def build(self, detector, sources):
+		# Extract features from every source image and save the result.
+		# Parameter detector is an OpenCV Feature2D.
+		kps = []
+		descs = []
+		offsets = [0]
+		for key, src in sources.items():
+			kp, des = detector.detectAndCompute(cv2.imread(src, 0), None)
+			if des is None:
+				des = np.zeros((0, detector.descriptorSize()), dtype=np.float32)
+			kps.append(keypoints_to_array(kp))
+			descs.append(des)
+			offsets.append(offsets[-1] + len(des))
+		
+		self._set(sources, np.concatenate(kps), np.concatenate(descs), np.array(offsets, dtype=np.int64))
+		try:
+			self.save({key: file_hash(src) for key, src in sources.items()})
+		except OSError:
+			print("Couldn't save reference index!")
+	
+	def save(self, hashes):
+		# Arrays go first and the manifest last, so an interrupted save is just treated as stale.
+		os.makedirs(self.path, exist_ok=True)
+		arrays = {
+			'keypoints.npy': self.keypoints,
+			'descriptors.npy': self.descriptors,
+			'offsets.npy': self.offsets
+		}
+		for name, arr in arrays.items():
+			tmp = self._file(name + '.tmp')
+			with open(tmp, 'wb') as f:
+				np.save(f, np.ascontiguousarray(arr))
+			os.replace(tmp, self._file(name))
+		
+		manifest = {'version': INDEX_VERSION, 'name': self.name, 'keys': self.keys, 'hashes': hashes}
+		tmp = self._file('manifest.json.tmp')
+		with open(tmp, 'w') as f:
+			json.dump(manifest, f, indent=1)
+		os.replace(tmp, self._file('manifest.json'))
+	
+	def load_or_build(self, detector, sources):
+		try:
+			if self.load(sources):
+				return False
+		except OSError:
+			pass
+		self.build(detector, sources)
+		return True
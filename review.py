@@ -0,0 +1,202 @@
+###############################################################################
+# Project: Polyhedral Dice Statistical Analysis (Diceview)
+# File   : review.py
+#
+# On-disk queue of die crops the recognisers weren't sure about.
+#
+# Copyright (c) 2020 Diceview Team
+# Released under the MIT License.
+#
+#   Date      SCR  Comment                                        Eng
+# -----------------------------------------------------------------------------
+#   20261017       Created                                        agent
+#
+###############################################################################
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+
+import dietypes
+
+
+REVIEW_DIR = 'review'
+# Crops are stored at the size of the reference face images
+CROP_SIZE = 250
+
+# Label value for a crop that isn't a readable die face
+NOT_A_DIE = 255
+
+# One row per stored crop. seq is 0 for an empty slot and counts up from 1 otherwise. kind and value are the
+# recogniser's guess (kind empty if it had none), label_kind and label_value a person's answer (label_value 0 until
+# labelled). promoted is set once a labelled crop has been copied into the reference library.
+ENTRY = np.dtype([
+	('seq', '<u8'),
+	('time', '<f8'),
+	('kind', 'S16'),
+	('value', 'u1'),
+	('score', '<f4'),
+	('margin', '<f4'),
+	('label_kind', 'S16'),
+	('label_value', 'u1'),
+	('promoted', '?')
+])
+
+
+class ReviewQueue(object):
+	# Bounded store of die crops: a memory mapped (capacity x CROP_SIZE x CROP_SIZE) greyscale array plus a memory
+	# mapped index of ENTRY rows, used as a ring. Once full, the oldest unlabelled crop is overwritten; labelled crops
+	# are kept until promoted. Opened on first use, and safe to share between threads.
+	def __init__(self, path=REVIEW_DIR, capacity=512):
+		self.path = path
+		self.capacity = capacity
+		self.crops = None
+		self.index = None
+		self._lock = threading.Lock()
+	
+	def _file(self, name):
+		return os.path.join(self.path, name)
+	
+	def open(self):
+		if self.index is not None:
+			return
+		os.makedirs(self.path, exist_ok=True)
+		try:
+			self.crops = np.load(self._file('crops.npy'), mmap_mode='r+')
+			self.index = np.load(self._file('index.npy'), mmap_mode='r+')
+			if self.index.dtype != ENTRY or len(self.crops) != len(self.index):
+				raise ValueError("review queue layout changed")
+			self.capacity = len(self.index)
+		except (OSError, ValueError):
+			self.crops = np.lib.format.open_memmap(
+				self._file('crops.npy'), mode='w+', dtype=np.uint8, shape=(self.capacity, CROP_SIZE, CROP_SIZE))
+			self.index = np.lib.format.open_memmap(
+				self._file('index.npy'), mode='w+', dtype=ENTRY, shape=(self.capacity,))
+	
+	def __len__(self):
+		if self.index is None:
+			return 0
+		return int(np.count_nonzero(self.index['seq']))
+	
+	def _free_slot(self):
+		# Empty slot first, then the oldest unlabelled or promoted crop. None if every slot holds an unpromoted label.
+		seq = self.index['seq']
+		empty = np.flatnonzero(seq == 0)
+		if len(empty):
+			return int(empty[0])
+		reusable = np.flatnonzero((self.index['label_value'] == 0) | self.index['promoted'])
+		if len(reusable) == 0:
+			return None
+		return int(reusable[np.argmin(seq[reusable])])
+	
+	def add(self, crop, key, score, margin):
+		# Store a colour or greyscale crop with the recogniser's key (or None), score and margin. Returns the slot, or
+		# None if the queue is full of labelled crops.
+		if crop.size == 0:
+			return None
+		if crop.ndim == 3:
+			crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+		crop = cv2.resize(crop, (CROP_SIZE, CROP_SIZE), interpolation=cv2.INTER_AREA)
+		kind, value = dietypes.parse_key(key) if key is not None else ('', 0)
+		with self._lock:
+			self.open()
+			slot = self._free_slot()
+			if slot is None:
+				return None
+			self.crops[slot] = crop
+			self.index[slot] = (int(self.index['seq'].max()) + 1, time.time(), kind.encode(), value, score, margin,
+				b'', 0, False)
+		return slot
+	
+	def pending(self):
+		# Slots still waiting for a label, least confident first.
+		self.open()
+		slots = np.flatnonzero((self.index['seq'] > 0) & (self.index['label_value'] == 0))
+		return slots[np.argsort(self.index['score'][slots], kind='stable')]
+	
+	def label(self, slot, kind, value):
+		# Record what a crop really shows. Parameter value is the face, or NOT_A_DIE.
+		with self._lock:
+			self.open()
+			if self.index['seq'][slot] == 0:
+				raise IndexError("empty review slot")
+			self.index['label_kind'][slot] = kind.encode()
+			self.index['label_value'][slot] = value
+			self.index['promoted'][slot] = False
+	
+	def promote(self):
+		# Copy every labelled crop of a registered die type into its reference library as an extra face image, see
+		# dietypes.DieType.sources. Recognisers pick them up on their next load. Returns the number copied.
+		self.open()
+		count = 0
+		with self._lock:
+			for slot in np.flatnonzero((self.index['label_value'] > 0) & ~self.index['promoted']):
+				entry = self.index[slot]
+				kind = entry['label_kind'].decode()
+				value = int(entry['label_value'])
+				if value == NOT_A_DIE or kind not in dietypes.registry:
+					continue
+				t = dietypes.get(kind)
+				path = os.path.join(t.path, dietypes.EXTRA_DIR, '{:d}-r{:d}.jpg'.format(value, int(entry['seq'])))
+				os.makedirs(os.path.dirname(path), exist_ok=True)
+				if not cv2.imwrite(path, np.asarray(self.crops[slot])):
+					print("Couldn't write reference image " + path)
+					continue
+				self.index['promoted'][slot] = True
+				count += 1
+		self.flush()
+		return count
+	
+	def flush(self):
+		with self._lock:
+			if self.index is not None:
+				self.crops.flush()
+				self.index.flush()
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Review die crops the recognisers weren't sure about.")
+	parser.add_argument('-d', '--dir', default=REVIEW_DIR, help="review queue directory")
+	sub = parser.add_subparsers(dest='command')
+	sub.add_parser('list', help="list crops waiting for a label")
+	p = sub.add_parser('export', help="write waiting crops as images to look at")
+	p.add_argument('out', help="output directory")
+	p = sub.add_parser('label', help="label a crop")
+	p.add_argument('slot', type=int)
+	p.add_argument('kind', help="die type, e.g. D20")
+	p.add_argument('value', help="face value, or x if it isn't a readable die face")
+	sub.add_parser('promote', help="copy labelled crops into the reference library")
+	args = parser.parse_args(argv)
+	
+	dietypes.discover()
+	queue = ReviewQueue(args.dir)
+	if not os.path.exists(os.path.join(args.dir, 'index.npy')):
+		print("No review queue in " + args.dir, file=sys.stderr)
+		return 1
+	queue.open()
+	
+	if args.command == 'export':
+		os.makedirs(args.out, exist_ok=True)
+		for slot in queue.pending():
+			cv2.imwrite(os.path.join(args.out, '{:d}.png'.format(slot)), np.asarray(queue.crops[slot]))
+	elif args.command == 'label':
+		queue.label(args.slot, args.kind.upper(), NOT_A_DIE if args.value == 'x' else int(args.value))
+		queue.flush()
+	elif args.command == 'promote':
+		print("Promoted {:d} crops".format(queue.promote()))
+	else:
+		print("{:>5} {:<8} {:>5} {:>6} {:>7}".format("slot", "guess", "value", "score", "margin"))
+		for slot in queue.pending():
+			entry = queue.index[slot]
+			print("{:5d} {:<8} {:5d} {:6.2f} {:7.2f}".format(
+				slot, entry['kind'].decode() or '-', entry['value'], entry['score'], entry['margin']))
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
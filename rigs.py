@@ -0,0 +1,291 @@
+###############################################################################
+# Project: Polyhedral Dice Statistical Analysis (Diceview)
+# File   : rigs.py
+#
+# Drive several camera and shaker stations from one process.
+#
+# Copyright (c) 2020 Diceview Team
+# Released under the MIT License.
+#
+#   Date      SCR  Comment                                        Eng
+# -----------------------------------------------------------------------------
+#   20261017       Created                                        agent
+#
+###############################################################################
+
+import argparse
+import json
+import queue
+import sys
+import time
+
+import numpy as np
+
+from vision import VisionThread, RECOGNIZERS, open_match_pool
+from motion import Motion
+from review import ReviewQueue
+from rolllog import RollLog
+from session import Session
+from sequential import SequentialTest, VERDICTS, UNDECIDED
+import cameras
+import dietypes
+import sim
+
+
+CONFIG_PATH = 'rigs.json'
+
+
+def make_cam(spec, profile=None):
+	# Camera from a config string: 'jetson[:sensor id]', 'usb[:index]', 'file:<path>' or 'sim[:dice]'.
+	kind, _, arg = spec.partition(':')
+	if kind == 'jetson':
+		return cameras.JetsonCam(profile or 'tray', sensor_id=int(arg or 0))
+	if kind == 'usb':
+		return cameras.USBCam(int(arg or 0), profile)
+	if kind == 'file':
+		return cameras.FileCam(arg, profile)
+	if kind == 'sim':
+		return sim.SimCam(int(arg or 5), profile=profile)
+	raise ValueError("unknown camera " + spec)
+
+
+class Rig(object):
+	# One station: its VisionThread and the dice statistics and roll log fed from it.
+	def __init__(self, name, vision, log_path, types, test):
+		self.name = name
+		self.vision = vision
+		self.session = Session(types, test=test)
+		self.log = RollLog(log_path)
+		self.test = test
+		self.actuations = 0
+		self.stopped = False
+		self._start = time.monotonic()
+		self._start_actuations = 0
+	
+	def resume(self):
+		# Replay this rig's roll log from earlier runs.
+		try:
+			rows = self.log.open()
+		except OSError:
+			print("Couldn't open roll log for {}!".format(self.name))
+			return
+		if len(rows) == 0:
+			return
+		self.actuations = int(rows['actuation'].max()) + 1
+		self._start_actuations = self.actuations
+		rows = rows[rows['die'] >= 0]
+		kinds = self.log.kind_names(rows)
+		self.session.replay(rows['die'], kinds, rows['value'], np.stack([rows['x'], rows['y']], axis=1))
+	
+	def drain(self):
+		# Record every result waiting on the vision queue. Returns how many there were.
+		count = 0
+		while True:
+			try:
+				dice, _ = self.vision.results.get_nowait()
+			except queue.Empty:
+				break
+			self.record(dice)
+			count += 1
+		return count
+	
+	def record(self, dice):
+		# Log and score one actuation's detections. Returns the die ids, see Session.record.
+		ids = self.session.record(dice)
+		self.log.append(self.actuations, dice, ids)
+		self.actuations += 1
+		return ids
+	
+	def verdicts(self):
+		store = self.session.store
+		return store.verdicts(self.test), store.n[:store.rows]
+	
+	def decided(self):
+		verdicts, n = self.verdicts()
+		return len(verdicts) > 0 and bool(np.all(self.test.finished(verdicts, n)))
+	
+	def stats(self):
+		store = self.session.store
+		verdicts, n = self.verdicts()
+		elapsed = max(time.monotonic() - self._start, 1e-9)
+		return {
+			'rig': self.name,
+			'actuations': self.actuations,
+			'rolls': int(n.sum()),
+			'rejected': self.vision.rejected,
+			'rate': (self.actuations - self._start_actuations) / elapsed,
+			'dice': store.rows,
+			'decided': int(np.count_nonzero(verdicts != UNDECIDED)),
+			'verdicts': " ".join("{}:{}".format(label, VERDICTS[int(v)]) for label, v in zip(store.labels(), verdicts)),
+			'stopped': self.stopped
+		}
+
+
+class RigManager(object):
+	# Runs every rig in the config from one process. Each rig has its own capture thread and pipelined VisionThread;
+	# all of them share one die matching pool, so there is one reference library in memory and the recognisers scale
+	# with cores rather than with rigs, and one review queue. Config entries are dicts with 'name', 'camera' (see
+	# make_cam), and optionally 'port' for the servo controller, 'profile' and 'log'.
+	def __init__(self, config, workers=None, processes=False, backend='auto', stop_when_decided=True):
+		self.config = config
+		self.workers = workers
+		self.processes = processes
+		self.backend = backend
+		self.stop_when_decided = stop_when_decided
+		self.test = SequentialTest()
+		self.pool = None
+		self.review = ReviewQueue()
+		self.rigs = []
+	
+	def start(self):
+		types = dietypes.active()
+		self.pool = open_match_pool(self.workers, self.processes, types, self.backend)
+		if self.pool is None:
+			return False
+		for entry in self.config:
+			name = entry['name']
+			cam = make_cam(entry['camera'], entry.get('profile'))
+			if isinstance(cam, sim.SimCam):
+				motion = sim.SimMotion(cam)
+			else:
+				motion = Motion(entry.get('port'))
+			vision = VisionThread(
+				name='vision-' + name, pipelined=True, cam=cam, motion=motion, pool=self.pool, review=self.review)
+			rig = Rig(name, vision, entry.get('log', 'rolls-{}.log'.format(name)), types, self.test)
+			rig.resume()
+			self.rigs.append(rig)
+		for rig in self.rigs:
+			rig.vision.start()
+			if self.stop_when_decided and rig.decided():
+				rig.stopped = True
+			else:
+				rig.vision.sample()
+		return True
+	
+	def poll(self):
+		# Take in every rig's results and stop the rigs whose dice are all decided. Returns the number of results.
+		count = 0
+		for rig in self.rigs:
+			count += rig.drain()
+			if self.stop_when_decided and not rig.stopped and rig.decided():
+				rig.vision.pause()
+				rig.stopped = True
+		return count
+	
+	def stats(self):
+		return [rig.stats() for rig in self.rigs]
+	
+	def stop(self):
+		for rig in self.rigs:
+			rig.vision.stop()
+		for rig in self.rigs:
+			rig.vision.join(timeout=10)
+			rig.drain()
+			rig.log.close()
+		if self.pool is not None:
+			self.pool.stop()
+		self.review.flush()
+
+
+class Dashboard(object):
+	# One Tk window with a row of figures per rig and a total row, refreshed every REFRESH seconds. Tk is only
+	# imported here, so the rest of this module, which daemon.py uses, works on a box without it.
+	REFRESH = 0.5
+	COLUMNS = (('rig', "Rig"), ('actuations', "Actuations"), ('rolls', "Dice Rolls"), ('rejected', "Rejected"),
+		('rate', "Actuations/s"), ('dice', "Dice"), ('decided', "Decided"), ('verdicts', "Verdicts"))
+	
+	def __init__(self, manager):
+		import tkinter
+		from tkinter import font
+		from tkinter import W, E
+		self.manager = manager
+		self.root = tkinter.Tk()
+		self.root.title("diceview rigs")
+		self.root.configure(bg="#eee", padx=10, pady=10)
+		self.font = font.Font(family='Trebuchet MS', size=14, weight='normal')
+		self.boldfont = font.Font(family='Trebuchet MS', size=14, weight='bold')
+		
+		for col, (_, title) in enumerate(self.COLUMNS):
+			tkinter.Label(self.root, text=title, font=self.boldfont, bg='#eee').grid(row=0, column=col, sticky=W, padx=8)
+		self.cells = []
+		for row in range(len(manager.rigs) + 1):
+			labels = []
+			for col in range(len(self.COLUMNS)):
+				label = tkinter.Label(self.root, text="", font=self.boldfont if row == len(manager.rigs) else self.font,
+					bg='#eee', anchor=W)
+				label.grid(row=row + 1, column=col, sticky=W + E, padx=8)
+				labels.append(label)
+			self.cells.append(labels)
+	
+	def refresh(self):
+		self.manager.poll()
+		stats = self.manager.stats()
+		total = {
+			'rig': "Total",
+			'actuations': sum(s['actuations'] for s in stats),
+			'rolls': sum(s['rolls'] for s in stats),
+			'rejected': sum(s['rejected'] for s in stats),
+			'rate': sum(s['rate'] for s in stats),
+			'dice': sum(s['dice'] for s in stats),
+			'decided': sum(s['decided'] for s in stats),
+			'verdicts': ""
+		}
+		for labels, s in zip(self.cells, stats + [total]):
+			for label, (key, _) in zip(labels, self.COLUMNS):
+				value = s[key]
+				if key == 'rate':
+					value = "{:.2f}".format(value)
+				elif key == 'rig' and s.get('stopped'):
+					value += " (stopped)"
+				label.configure(text=str(value))
+		self.root.after(int(self.REFRESH * 1000), self.refresh)
+	
+	def shutdown(self):
+		self.root.destroy()
+		self.manager.stop()
+	
+	def run(self):
+		self.root.protocol("WM_DELETE_WINDOW", self.shutdown)
+		self.root.after(1, self.refresh)
+		self.root.mainloop()
+
+
+def run_headless(manager, interval):
+	# Print a line per rig every interval seconds until interrupted.
+	try:
+		while True:
+			time.sleep(interval)
+			manager.poll()
+			for s in manager.stats():
+				print("{rig:<10} {actuations:8d} actuations {rolls:9d} rolls {rejected:6d} rejected {rate:6.2f}/s  "
+					"{verdicts}".format(**s))
+	except KeyboardInterrupt:
+		pass
+	finally:
+		manager.stop()
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Run several dice rigs from one process.")
+	parser.add_argument('config', nargs='?', default=CONFIG_PATH, help="JSON list of rigs")
+	parser.add_argument('-w', '--workers', type=int, default=None, help="die matching workers shared by every rig")
+	parser.add_argument('--processes', action='store_true', help="match dice in worker processes instead of threads")
+	parser.add_argument('-r', '--recognizer', choices=RECOGNIZERS, default='auto', help="die face recogniser")
+	parser.add_argument('--keep-rolling', action='store_true', help="don't stop rigs whose dice are all decided")
+	parser.add_argument('--headless', type=float, metavar='SECONDS', help="print stats at this interval, no window")
+	args = parser.parse_args(argv)
+	
+	with open(args.config) as f:
+		config = json.load(f)
+	manager = RigManager(config, args.workers, args.processes, args.recognizer, not args.keep_rolling)
+	if not manager.start():
+		return 1
+	if args.headless:
+		run_headless(manager, args.headless)
+	else:
+		Dashboard(manager).run()
+	return 0
+
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,150 @@
+###############################################################################
+# Project: Polyhedral Dice Statistical Analysis (Diceview)
+# File   : rolllog.py
+#
+# Append-only on-disk log of every actuation's results.
+#
+# Copyright (c) 2020 Diceview Team
+# Released under the MIT License.
+#
+#   Date      SCR  Comment                                        Eng
+# -----------------------------------------------------------------------------
+#   20261017       Created                                        agent
+#
+###############################################################################
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+
+LOG_PATH = 'rolls.log'
+
+# One fixed-size little-endian row per recognised die. An actuation with no recognised dice still gets one row, with
+# die -1 and value 0, so the actuation count survives. frame is -1 when there is no archived frame to refer to.
+ROW = np.dtype([
+	('time', '<f8'),
+	('actuation', '<u4'),
+	('frame', '<i4'),
+	('die', '<i2'),
+	('kind', 'u1'),
+	('value', 'u1'),
+	('x', '<f4'),
+	('y', '<f4')
+])
+
+
+class RollLog(object):
+	# Rows are buffered in memory and written and fsynced together every fsync_interval seconds, so a crash loses at
+	# most that much. A background thread does the same while no rows come in, e.g. once the rig has stopped. Die type
+	# names are stored once in a small sidecar file and rows refer to them by index. Because rows are fixed size, the
+	# whole log loads with one np.fromfile and can be replayed with vectorised numpy; a torn final row from a crash
+	# mid-write is cut off on open.
+	def __init__(self, path=LOG_PATH, fsync_interval=1.0):
+		self.path = path
+		self.kinds_path = path + '.kinds.json'
+		self.fsync_interval = fsync_interval
+		self.kinds = []
+		self._f = None
+		self._buf = bytearray()
+		self._last_sync = time.monotonic()
+		self._lock = threading.Lock()
+		self._closing = threading.Event()
+		self._flusher = None
+	
+	def read(self):
+		# Load everything logged so far without opening the log for appending, so it is safe while another process
+		# writes it. A torn or half written final row is left out. Returns the rows as a ROW array.
+		try:
+			with open(self.kinds_path) as f:
+				self.kinds = json.load(f)
+		except (OSError, ValueError):
+			self.kinds = []
+		
+		if not os.path.exists(self.path):
+			return np.zeros(0, dtype=ROW)
+		rows = np.fromfile(self.path, dtype=ROW, count=os.path.getsize(self.path) // ROW.itemsize)
+		if len(rows) and rows['kind'].max() >= len(self.kinds):
+			print("Roll log refers to unknown die types!")
+		return rows
+	
+	def open(self):
+		# Load everything logged so far and open the log for appending. Returns the rows as a ROW array.
+		rows = self.read()
+		if os.path.exists(self.path) and os.path.getsize(self.path) != len(rows) * ROW.itemsize:
+			print("Dropping torn record at end of roll log!")
+			with open(self.path, 'r+b') as f:
+				f.truncate(len(rows) * ROW.itemsize)
+		self._f = open(self.path, 'ab')
+		self._closing.clear()
+		self._flusher = threading.Thread(target=self._flush_loop, name='rolllog-sync', daemon=True)
+		self._flusher.start()
+		return rows
+	
+	def _flush_loop(self):
+		while not self._closing.wait(self.fsync_interval):
+			self.sync()
+	
+	def kind_names(self, rows):
+		# Die type name of each row.
+		return np.array(self.kinds + [''])[np.minimum(rows['kind'], len(self.kinds))]
+	
+	def _kind(self, name):
+		if name not in self.kinds:
+			self.kinds.append(name)
+			# Saved straight away so rows that refer to it can never be durable before it is.
+			tmp = self.kinds_path + '.tmp'
+			with open(tmp, 'w') as f:
+				json.dump(self.kinds, f)
+				f.flush()
+				os.fsync(f.fileno())
+			os.replace(tmp, self.kinds_path)
+		return self.kinds.index(name)
+	
+	def append(self, actuation, detections, ids, frame=-1, timestamp=None):
+		# Log one actuation. Parameter ids holds the die id of each detection, as given by Session.record.
+		rows = np.zeros(max(len(detections), 1), dtype=ROW)
+		rows['time'] = time.time() if timestamp is None else timestamp
+		rows['actuation'] = actuation
+		rows['frame'] = frame
+		if detections:
+			rows['die'] = ids
+			rows['kind'] = [self._kind(det.kind) for det in detections]
+			rows['value'] = [det.value for det in detections]
+			rows['x'] = [det.pt[0] for det in detections]
+			rows['y'] = [det.pt[1] for det in detections]
+		else:
+			rows['die'] = -1
+		with self._lock:
+			self._buf += rows.tobytes()
+		
+		if time.monotonic() - self._last_sync >= self.fsync_interval:
+			self.sync()
+	
+	def sync(self):
+		with self._lock:
+			self._last_sync = time.monotonic()
+			if self._f is None:
+				# Not open, nowhere to keep it
+				self._buf = bytearray()
+				return
+			if not self._buf:
+				return
+			self._f.write(self._buf)
+			self._f.flush()
+			os.fsync(self._f.fileno())
+			self._buf = bytearray()
+	
+	def close(self):
+		if self._flusher is not None:
+			self._closing.set()
+			self._flusher.join()
+			self._flusher = None
+		if self._f is not None:
+			self.sync()
+			with self._lock:
+				self._f.close()
+				self._f = None
@@ -0,0 +1,78 @@
+###############################################################################
+# Project: Polyhedral Dice Statistical Analysis (Diceview)
+# File   : sequential.py
+#
+# Sequential test deciding whether a die is fair as the rolls come in.
+#
+# Copyright (c) 2020 Diceview Team
+# Released under the MIT License.
+#
+#   Date      SCR  Comment                                        Eng
+# -----------------------------------------------------------------------------
+#   20261017       Created                                        agent
+#
+###############################################################################
+
+import math
+
+import numpy as np
+from scipy import stats
+
+
+UNDECIDED = 0
+FAIR = 1
+BIASED = 2
+
+VERDICTS = {UNDECIDED: "undecided", FAIR: "fair", BIASED: "biased"}
+
+
+class SequentialTest(object):
+	# Wald's sequential probability ratio test in its chi-squared form. The hypotheses are a fair die against a bias of
+	# effect size w = sqrt(k * sum((p_i - 1/k)^2)) (Cohen's w; 0.1 is small, 0.3 medium). After n rolls, the Pearson
+	# chi-squared is central with k - 1 degrees of freedom under the first and non-central with parameter n * w^2
+	# under the second. Their log likelihood ratio is checked against Wald's bounds after every roll, so a die is
+	# decided as soon as the evidence allows, with error rates of about alpha (calling a fair die biased) and beta
+	# (calling a die with bias w fair). Everything takes numpy arrays, so a whole tray is checked at once.
+	def __init__(self, effect=0.1, alpha=0.05, beta=0.05, max_rolls=None):
+		# Parameter max_rolls, if given, ends the test undecided rather than rolling forever.
+		self.effect = effect
+		self.alpha = alpha
+		self.beta = beta
+		self.max_rolls = max_rolls
+		self.upper = math.log((1.0 - beta) / alpha)
+		self.lower = math.log(beta / (1.0 - alpha))
+	
+	@staticmethod
+	def min_rolls(sides):
+		# The chi-squared approximation needs about five expected rolls of each face.
+		return 5 * np.asarray(sides)
+	
+	def log_ratio(self, chi_squared, n, sides):
+		# Log likelihood ratio of a biased die over a fair one.
+		df = np.asarray(sides) - 1
+		nc = np.asarray(n, dtype=np.float64) * self.effect * self.effect
+		with np.errstate(invalid='ignore', divide='ignore'):
+			return stats.ncx2.logpdf(chi_squared, df, nc) - stats.chi2.logpdf(chi_squared, df)
+	
+	def decide(self, chi_squared, n, sides):
+		# Verdict for each die: UNDECIDED, FAIR or BIASED.
+		n = np.asarray(n)
+		llr = self.log_ratio(chi_squared, n, sides)
+		verdict = np.full(np.shape(llr), UNDECIDED, dtype=np.int8)
+		ready = n >= self.min_rolls(sides)
+		verdict[ready & (llr <= self.lower)] = FAIR
+		verdict[ready & (llr >= self.upper)] = BIASED
+		return verdict
+	
+	def check(self, die):
+		# Verdict for one Die.
+		if die.n == 0:
+			return UNDECIDED
+		return int(self.decide(die.chi_squared(), die.n, die.sides))
+	
+	def finished(self, verdict, n):
+		# Whether testing is over for each die, decided or out of rolls.
+		done = np.asarray(verdict) != UNDECIDED
+		if self.max_rolls is not None:
+			done |= np.asarray(n) >= self.max_rolls
+		return done
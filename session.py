@@ -0,0 +1,258 @@
+###############################################################################
+# Project: Polyhedral Dice Statistical Analysis (Diceview)
+# File   : session.py
+#
+# Per-die tracking and statistics for a tray of many dice.
+#
+# Copyright (c) 2020 Diceview Team
+# Released under the MIT License.
+#
+#   Date      SCR  Comment                                        Eng
+# -----------------------------------------------------------------------------
+#   20261017       Created                                        agent
+#
+###############################################################################
+
+import math
+
+import numpy as np
+from scipy import stats
+
+from die import chi_squared_trace
+from sequential import VERDICTS, UNDECIDED
+
+
+class DiceTracker(object):
+	# Gives each die a stable id across frames. Shaking moves dice anywhere in an open tray, so by default position says
+	# nothing about which die is which and only the type does: every detection of a type gets that type's one id. With
+	# one die of each type, as the rig is meant to be run, that id is one physical die. Several dice of one type can't
+	# be told apart this way, so their rolls are pooled under the one id and judged together; attribute pooled holds
+	# the types that have been seen more than once in a frame.
+	# With max_dist, for trays where each die stays in its own compartment, each detection is instead paired with the
+	# nearest track of the same type within max_dist, closest pairs first, and anything left over starts a new track.
+	def __init__(self, max_dist=None):
+		self.max_dist = max_dist
+		# Per track: die type name and last (x, y)
+		self.kinds = []
+		self.positions = []
+		self.pooled = set()
+	
+	def __len__(self):
+		return len(self.kinds)
+	
+	def assign(self, detections):
+		# Returns a track id for each detection, in order.
+		if self.max_dist is None:
+			return self._assign_by_type(detections)
+		pairs = []
+		for i, det in enumerate(detections):
+			for track, (kind, pos) in enumerate(zip(self.kinds, self.positions)):
+				if kind != det.kind:
+					continue
+				dist = math.hypot(det.pt[0] - pos[0], det.pt[1] - pos[1])
+				if dist <= self.max_dist:
+					pairs.append((dist, i, track))
+		pairs.sort()
+		
+		ids = [None] * len(detections)
+		taken = set()
+		for dist, i, track in pairs:
+			if ids[i] is None and track not in taken:
+				ids[i] = track
+				taken.add(track)
+		
+		for i, det in enumerate(detections):
+			if ids[i] is None:
+				ids[i] = len(self.kinds)
+				self.kinds.append(det.kind)
+				self.positions.append(det.pt)
+			else:
+				self.positions[ids[i]] = det.pt
+		return ids
+	
+	def _assign_by_type(self, detections):
+		ids = []
+		for det in detections:
+			if det.kind in self.kinds:
+				track = self.kinds.index(det.kind)
+				self.positions[track] = det.pt
+				if track in ids and det.kind not in self.pooled:
+					print("Several {} dice in the tray! Their rolls are pooled and judged together.".format(det.kind))
+					self.pooled.add(det.kind)
+			else:
+				track = len(self.kinds)
+				self.kinds.append(det.kind)
+				self.positions.append(det.pt)
+			ids.append(track)
+		return ids
+
+
+class RollStore(object):
+	# Statistics for every tracked die in shared column arrays, one row per die: sides, roll count, sum and sum of
+	# squares of the values, latched verdict, and a (dice x faces) count matrix. Rows and face columns grow by doubling,
+	# so adding a batch of rolls is a handful of vectorised scatter-adds whatever the mix of dice.
+	def __init__(self, capacity=16, faces=20):
+		self.rows = 0
+		self.kinds = []
+		self.sides = np.zeros(capacity, dtype=np.int64)
+		self.n = np.zeros(capacity, dtype=np.int64)
+		self.total = np.zeros(capacity, dtype=np.int64)
+		self.total_sq = np.zeros(capacity, dtype=np.int64)
+		self.verdict = np.full(capacity, UNDECIDED, dtype=np.int8)
+		self.counts = np.zeros((capacity, faces), dtype=np.int64)
+	
+	def _grow(self, rows, faces):
+		cap, width = self.counts.shape
+		if rows <= cap and faces <= width:
+			return
+		while cap < rows:
+			cap *= 2
+		while width < faces:
+			width *= 2
+		counts = np.zeros((cap, width), dtype=np.int64)
+		counts[:self.rows, :self.counts.shape[1]] = self.counts[:self.rows]
+		self.counts = counts
+		for name in ('sides', 'n', 'total', 'total_sq', 'verdict'):
+			col = np.zeros(cap, dtype=getattr(self, name).dtype)
+			col[:self.rows] = getattr(self, name)[:self.rows]
+			setattr(self, name, col)
+	
+	def add_die(self, kind, sides):
+		# Returns the new row.
+		self._grow(self.rows + 1, sides)
+		row = self.rows
+		self.kinds.append(kind)
+		self.sides[row] = sides
+		self.rows += 1
+		return row
+	
+	def add(self, rows, values):
+		# Parameters rows and values are equal length sequences of store rows and face values.
+		rows = np.asarray(rows, dtype=np.int64)
+		values = np.asarray(values, dtype=np.int64)
+		if len(rows) == 0:
+			return
+		if values.min() < 1 or np.any(values > self.sides[rows]):
+			raise ValueError("roll out of range")
+		np.add.at(self.counts, (rows, values - 1), 1)
+		np.add.at(self.n, rows, 1)
+		np.add.at(self.total, rows, values)
+		np.add.at(self.total_sq, rows, values * values)
+	
+	def mean(self):
+		n = self.n[:self.rows]
+		with np.errstate(invalid='ignore', divide='ignore'):
+			return self.total[:self.rows] / n
+	
+	def chi_squared(self):
+		# Chi-squared of each die against a fair die of its own number of sides.
+		n = self.n[:self.rows].astype(np.float64)
+		counts = self.counts[:self.rows].astype(np.float64)
+		with np.errstate(invalid='ignore', divide='ignore'):
+			return self.sides[:self.rows] * np.sum(counts * counts, axis=1) / n - n
+	
+	def p_values(self):
+		return stats.chi2.sf(self.chi_squared(), self.sides[:self.rows] - 1)
+	
+	def labels(self):
+		# Name of each die for display: its type, numbered within the type if there are several, e.g. 'd6 #2'.
+		out = []
+		for row, kind in enumerate(self.kinds):
+			if self.kinds.count(kind) > 1:
+				out.append("{} #{:d}".format(kind, self.kinds[:row].count(kind) + 1))
+			else:
+				out.append(kind)
+		return out
+	
+	def verdicts(self, test):
+		# Verdict of a sequential.SequentialTest for each die, latched: a die keeps the verdict it was first given, so
+		# rolling on past a decision can't take it back as the statistic wanders.
+		verdict = self.verdict[:self.rows]
+		undecided = verdict == UNDECIDED
+		verdict[undecided] = test.decide(self.chi_squared(), self.n[:self.rows], self.sides[:self.rows])[undecided]
+		return verdict.copy()
+	
+	def summary(self, test=None):
+		# One dict per die, in row order, with the verdict of test if one is given.
+		out = []
+		verdicts = self.verdicts(test) if test is not None else [None] * self.rows
+		for row, (mean, chi, p, verdict) in enumerate(zip(self.mean(), self.chi_squared(), self.p_values(), verdicts)):
+			out.append({
+				'die': row,
+				'kind': self.kinds[row],
+				'rolls': int(self.n[row]),
+				'average': float(mean),
+				'chi_squared': float(chi),
+				'p_value': float(p),
+				'count': self.counts[row, :self.sides[row]].tolist()
+			})
+			if verdict is not None:
+				out[-1]['verdict'] = VERDICTS[int(verdict)]
+		return out
+
+
+class Session(object):
+	# Tracks the physical dice seen in each frame and feeds their rolls into a shared RollStore.
+	# Parameter types maps die type name to DieType, for the number of sides of newly seen dice. With a
+	# sequential.SequentialTest as test, each die's verdict is latched as soon as it is decided, see RollStore.verdicts.
+	def __init__(self, types, max_dist=None, test=None):
+		self.types = dict((t.name, t) for t in types)
+		self.tracker = DiceTracker(max_dist)
+		self.store = RollStore()
+		self.test = test
+		self._rows = []
+	
+	def record(self, detections):
+		# Returns the die id of each detection.
+		ids = self.tracker.assign(detections)
+		for track in range(len(self._rows), len(self.tracker)):
+			kind = self.tracker.kinds[track]
+			self._rows.append(self.store.add_die(kind, self.types[kind].sides))
+		self.store.add([self._rows[i] for i in ids], [det.value for det in detections])
+		if self.test is not None:
+			self.store.verdicts(self.test)
+		return ids
+	
+	def replay(self, ids, kinds, values, pts):
+		# Rebuild tracks and statistics from logged rolls, oldest first. Parameters are equal length arrays of die ids
+		# as returned by record(), type names, face values and (x, y) positions. Dice of types that aren't active any
+		# more keep their ids, so later ones still line up, but their rolls are skipped, as are rolls out of range.
+		ids = np.asarray(ids, dtype=np.int64)
+		if len(ids) == 0:
+			return
+		values = np.asarray(values, dtype=np.int64)
+		pts = np.asarray(pts, dtype=np.float64)
+		# Die ids are handed out in order from 0, so the unique ids are 0..n-1
+		unique, first = np.unique(ids, return_index=True)
+		_, last_rev = np.unique(ids[::-1], return_index=True)
+		last = len(ids) - 1 - last_rev
+		for die, i, j in zip(unique, first, last):
+			if die < len(self._rows):
+				continue
+			kind = str(kinds[i])
+			self.tracker.kinds.append(kind)
+			self.tracker.positions.append((float(pts[j, 0]), float(pts[j, 1])))
+			self._rows.append(self.store.add_die(kind, self.types[kind].sides) if kind in self.types else -1)
+		rows = np.asarray(self._rows)[ids]
+		valid = rows >= 0
+		valid[valid] = (values[valid] >= 1) & (values[valid] <= self.store.sides[rows[valid]])
+		if not np.all(valid):
+			print("Skipping {:d} logged rolls of unknown die types or out of range!".format(int(np.count_nonzero(~valid))))
+		self.store.add(rows[valid], values[valid])
+		if self.test is not None:
+			self._latch(rows[valid], values[valid])
+	
+	def _latch(self, rows, values):
+		# Latch each replayed die's verdict at the first roll it was decided on, as recording them live would have.
+		store = self.store
+		for row in np.unique(rows):
+			if store.verdict[row] != UNDECIDED:
+				continue
+			mine = values[rows == row]
+			sides = store.sides[row]
+			before = store.counts[row, :sides] - np.bincount(mine - 1, minlength=sides)
+			n = before.sum() + np.arange(1, len(mine) + 1)
+			decided = self.test.decide(chi_squared_trace(mine, sides, before), n, sides)
+			first = np.flatnonzero(decided != UNDECIDED)
+			if len(first):
+				store.verdict[row] = decided[first[0]]
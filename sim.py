@@ -0,0 +1,313 @@
+###############################################################################
+# Project: Polyhedral Dice Statistical Analysis (Diceview)
+# File   : sim.py
+#
+# Simulated camera, shaker and dice for running without the rig.
+#
+# Copyright (c) 2020 Diceview Team
+# Released under the MIT License.
+#
+#   Date      SCR  Comment                                        Eng
+# -----------------------------------------------------------------------------
+#   20261017       Created                                        agent
+#
+###############################################################################
+
+import argparse
+import math
+import os
+import random
+import sys
+import threading
+import time
+
+import cv2
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from cameras import BaseCam, get_profile
+from die import Die, chi_squared_trace
+from history import SeriesHistory
+import dietypes
+import graphs
+import perf
+import vision
+
+
+def load_faces(name='D20'):
+	die_type = dietypes.get(name)
+	faces = dict()
+	for i in range(1, die_type.sides + 1):
+		faces[i] = cv2.imread(die_type.face_path(i), 0)
+	return faces
+
+
+def face_probs(sides, bias=None):
+	# Probability of each face. Parameter bias maps face value to a relative weight, e.g. {20: 1.5} makes a 20 half as
+	# likely again as any other face; missing faces weigh 1.
+	weights = np.ones(sides, dtype=np.float64)
+	for face, weight in (bias or {}).items():
+		weights[face - 1] = weight
+	return weights / weights.sum()
+
+
+def place_dice(count, shape, rng, layouts=20):
+	# Centres for up to count DICE_SIZE squares inside the tray circle and frame of the given shape, no two overlapping.
+	# Random placement jams well before the tray is full, so a few fresh layouts are tried and the fullest kept.
+	size = vision.DICE_SIZE
+	best = []
+	for _ in range(layouts):
+		placed = []
+		attempts = 0
+		while len(placed) < count and attempts < 1000:
+			attempts += 1
+			angle = rng.uniform(0, 2 * math.pi)
+			radius = rng.uniform(0, vision.CIRCLE_RADIUS - size * 0.75)
+			cx = int(vision.CIRCLE_POS[0] + radius * math.cos(angle))
+			cy = int(vision.CIRCLE_POS[1] + radius * math.sin(angle))
+			if any(max(abs(cx - px), abs(cy - py)) < size for px, py in placed):
+				continue
+			x0 = cx - size // 2
+			y0 = cy - size // 2
+			if x0 < 0 or y0 < 0 or x0 + size > shape[1] or y0 + size > shape[0]:
+				continue
+			placed.append((cx, cy))
+		if len(placed) > len(best):
+			best = placed
+		if len(best) == count:
+			break
+	return best
+
+
+def synth_tray(ref, faces, count, rng, probs=None):
+	# Composite count randomly rotated face crops onto the empty tray, see place_dice. Each crop is a whole square, so
+	# squares must not overlap at all or the dice merge into one blob; only about five fit in the tray circle. Face
+	# values are uniform, or drawn with the given per-face probabilities.
+	# Returns the frame and the face values placed on it.
+	tray = ref.copy()
+	size = vision.DICE_SIZE
+	values = []
+	for cx, cy in place_dice(count, tray.shape, rng):
+		if probs is None:
+			value = rng.randint(1, len(faces))
+		else:
+			value = rng.choices(range(1, len(faces) + 1), weights=probs)[0]
+		rot = cv2.getRotationMatrix2D((size * 0.5, size * 0.5), rng.uniform(0, 360), 1.0)
+		face = cv2.warpAffine(faces[value], rot, (size, size), borderMode=cv2.BORDER_REPLICATE)
+		x0 = cx - size // 2
+		y0 = cy - size // 2
+		tray[y0:y0 + size, x0:x0 + size] = cv2.cvtColor(face, cv2.COLOR_GRAY2BGR)
+		values.append(value)
+	return tray, values
+
+
+class RollGenerator(object):
+	# Vectorised source of die rolls, fair or with the given per-face probabilities. Tens of millions of rolls a
+	# second, for soak testing the statistics and graphs without the vision pipeline.
+	def __init__(self, sides, probs=None, seed=None):
+		self.sides = sides
+		self._rng = np.random.default_rng(seed)
+		self._cdf = None if probs is None else np.cumsum(probs)
+	
+	def rolls(self, n):
+		if self._cdf is None:
+			return self._rng.integers(1, self.sides + 1, size=n, dtype=np.int64)
+		faces = np.searchsorted(self._cdf, self._rng.random(n) * self._cdf[-1], side='right')
+		return np.minimum(faces, self.sides - 1).astype(np.int64) + 1
+
+
+class SimCam(BaseCam):
+	# Renders synthetic tray frames from the reference faces, paced to fps. After shake() the dice jump to a new random
+	# layout on each of the next moving_frames frames, then stay put, so the settle detector sees them move and stop.
+	# truth holds the face values in the current layout.
+	def __init__(self, count=5, die='D20', bias=None, fps=21, seed=None, profile=None, moving_frames=4):
+		self.count = count
+		self.die = die
+		self.bias = bias
+		self.fps = fps
+		self.profile = get_profile(profile)
+		self.moving_frames = moving_frames
+		self.truth = []
+		self._rng = random.Random(seed)
+		self._ref = None
+		self._faces = None
+		self._probs = None
+		self._frame = None
+		self._moving = 0
+		self._lock = threading.Lock()
+		self._open = False
+		self._due = 0.0
+	
+	def start(self):
+		if self._ref is None:
+			self._ref = cv2.imread(os.path.join('refim', 'ref.jpg'))
+			self._faces = load_faces(self.die)
+			if self.bias:
+				self._probs = face_probs(len(self._faces), self.bias).tolist()
+		self._open = self._ref is not None
+		if not self._open:
+			print("Couldn't open camera!")
+			return
+		self._render()
+		self._due = time.monotonic()
+	
+	def stop(self):
+		self._open = False
+	
+	def ready(self):
+		return self._open
+	
+	def shake(self):
+		with self._lock:
+			self._moving = self.moving_frames
+	
+	def _render(self):
+		self._frame, self.truth = synth_tray(self._ref, self._faces, self.count, self._rng, self._probs)
+	
+	def get_frame(self):
+		if self.fps:
+			self._due += 1.0 / self.fps
+			delay = self._due - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+			else:
+				self._due = time.monotonic()
+		if not self._open:
+			return None
+		with self._lock:
+			moving = self._moving > 0
+			if moving:
+				self._moving -= 1
+		if moving:
+			self._render()
+		frame = self._frame
+		if self.profile is not None:
+			frame = self.profile.apply(frame)
+		return frame
+
+
+class SimMotion(object):
+	# Stands in for motion.Motion: actuating shakes a SimCam instead of a servo. For the real serial protocol without
+	# hardware, use motion.Motion on a fakeservo.FakeController instead.
+	TRAVEL = 0.2
+	
+	def __init__(self, cam=None):
+		self.cam = cam
+	
+	def actuate(self):
+		time.sleep(self.TRAVEL)
+		if self.cam is not None:
+			self.cam.shake()
+	
+	def roll(self):
+		# Block until the simulated dice have stopped.
+		self.actuate()
+		if self.cam is not None and self.cam.fps:
+			time.sleep((self.cam.moving_frames + 1) / float(self.cam.fps))
+	
+	def close(self):
+		pass
+
+
+def parse_bias(items):
+	# ['20:1.5', ...] -> {20: 1.5, ...}
+	bias = dict()
+	for item in items or []:
+		face, weight = item.split(':')
+		bias[int(face)] = float(weight)
+	return bias
+
+
+def soak(args):
+	# Push generated rolls through Die, the chi-squared history and both graphs, drawn off screen, as fast as possible,
+	# reporting throughput, stage timings and memory as it goes.
+	# Imported here as the GUI imports this module, and resource is Unix only
+	try:
+		import resource
+	except ImportError:
+		resource = None
+	
+	graphs.REDRAW_INTERVAL = 0.0
+	probs = face_probs(args.sides, parse_bias(args.bias)) if args.bias else None
+	gen = RollGenerator(args.sides, probs, args.seed)
+	die = Die('D{:d}'.format(args.sides), args.sides)
+	history = SeriesHistory()
+	plot_bar = graphs.CountGraph(args.sides)
+	plot_chi = graphs.ChiGraph()
+	plot_bar.attach(FigureCanvasAgg(plot_bar.figure))
+	plot_chi.attach(FigureCanvasAgg(plot_chi.figure))
+	
+	timer = perf.Perf()
+	start = time.perf_counter()
+	batches = int(math.ceil(args.rolls / float(args.batch)))
+	for i in range(batches):
+		with timer.time('generate'):
+			rolls = gen.rolls(min(args.batch, args.rolls - die.n))
+		with timer.time('stats'):
+			# One chi-squared point per roll, as if each had come from its own actuation
+			history.extend(chi_squared_trace(rolls, die.sides, die.count))
+			die.add_rolls(rolls)
+		with timer.time('redraw'):
+			plot_bar.update(die.count)
+			plot_chi.update(*history.data())
+			plot_bar.flush()
+			plot_chi.flush()
+		
+		if (i + 1) % args.report == 0 or i + 1 == batches:
+			elapsed = time.perf_counter() - start
+			line = "{:d} rolls, {:.0f} rolls/s, chi-squared {:.2f}, p {:.3f}".format(
+				die.n, die.n / elapsed, die.chi_squared(), die.p_value())
+			if resource is not None:
+				line += ", max RSS {:.1f} MB".format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+			print(line)
+	print("ms       {:>7} {:>7} {:>7}".format("p50", "p95", "max"))
+	print(timer.format(['generate', 'stats', 'redraw']))
+	return 0
+
+
+def frames(args):
+	# Write synthetic tray frames for batch.py and bench.py, with the true values in a CSV alongside.
+	ref = cv2.imread(os.path.join('refim', 'ref.jpg'))
+	faces = load_faces(args.die)
+	probs = face_probs(len(faces), parse_bias(args.bias)).tolist() if args.bias else None
+	rng = random.Random(args.seed)
+	os.makedirs(args.out, exist_ok=True)
+	with open(os.path.join(args.out, 'truth.csv'), 'w') as f:
+		f.write("frame,values\n")
+		for i in range(args.frames):
+			tray, values = synth_tray(ref, faces, args.dice, rng, probs)
+			name = '{:06d}.png'.format(i)
+			cv2.imwrite(os.path.join(args.out, name), tray)
+			f.write("{},{}\n".format(name, ' '.join(str(v) for v in values)))
+	return 0
+
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Simulate dice without the rig.")
+	sub = parser.add_subparsers(dest='command')
+	p = sub.add_parser('soak', help="push generated rolls through the statistics and graphs")
+	p.add_argument('--rolls', type=int, default=100000000)
+	p.add_argument('--batch', type=int, default=1000000, help="rolls per update")
+	p.add_argument('--sides', type=int, default=20)
+	p.add_argument('--report', type=int, default=10, help="batches between progress lines")
+	p.add_argument('--bias', nargs='+', metavar='FACE:WEIGHT', help="relative weights of faces, e.g. 20:1.5")
+	p.add_argument('--seed', type=int, default=None)
+	p = sub.add_parser('frames', help="write synthetic tray frames")
+	p.add_argument('out', help="output directory")
+	p.add_argument('--frames', type=int, default=100)
+	p.add_argument('--dice', type=int, default=5, help="dice per frame")
+	p.add_argument('--die', default='D20', help="die type")
+	p.add_argument('--bias', nargs='+', metavar='FACE:WEIGHT', help="relative weights of faces, e.g. 20:1.5")
+	p.add_argument('--seed', type=int, default=0)
+	args = parser.parse_args(argv)
+	
+	if args.command == 'frames':
+		return frames(args)
+	if args.command == 'soak':
+		return soak(args)
+	parser.print_help()
+	return 1
+
+
+if __name__ == '__main__':
+	sys.exit(main())
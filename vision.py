@@ -13,56 +13,406 @@
 #
 ###############################################################################
 
+import queue
 import random
 import threading
+import time
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import cv2
 import numpy as np
-from collections import namedtuple
 import os
 
 from motion import Motion
+from refindex import ReferenceIndex, keypoints_to_array
+from review import ReviewQueue
 import cameras
+import dietypes
+import perf
 
 
 # Params
 DICE_SIZE = 250
+# Tray circle, in pixels of the reference image
 CIRCLE_POS = (540, 460)
-image_height, image_width = (862, 1142)
-circle_mask = np.zeros((image_height, image_width), dtype=np.uint8)
-circle_mask = cv2.circle(circle_mask, CIRCLE_POS, 470, 1, thickness=-1)
+CIRCLE_RADIUS = 470
 
 
-def subtract_and_mask(img, ref):
-	img = cv2.absdiff(ref, img.copy())
-	img = cv2.bitwise_and(img, img, mask=circle_mask)
-	return img
+class BackgroundModel(object):
+	# Empty tray reference frame and tray mask. Both are loaded and fitted to the camera resolution once, and the
+	# subtraction, threshold and morphology stages write into preallocated buffers, so a frame costs no disk I/O and no
+	# allocations. With a non-zero learn_rate the reference also tracks lighting drift, blended in from empty tray
+	# frames.
+	THRESHOLD = 25
+	
+	def __init__(self, path=os.path.join('refim', 'ref.jpg'), learn_rate=0.0):
+		self.path = path
+		self.learn_rate = learn_rate
+		self.shape = None
+		# Linear scale from reference image pixels to camera pixels
+		self.scale = 1.0
+		self.ref = None
+		self.mask = None
+		self._source = None
+		self._ref_acc = None
+		self._kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+		self._grey = None
+		self._diff = None
+		self._masked = None
+		self._thresh = None
+		self._fg = None
+	
+	def mask_for(self, shape):
+		# Tray mask scaled to any (height, width).
+		if self._source is None:
+			self._source = cv2.imread(self.path, 0)
+		height, width = shape
+		sx = width / float(self._source.shape[1])
+		sy = height / float(self._source.shape[0])
+		mask = np.zeros((height, width), dtype=np.uint8)
+		center = (int(round(CIRCLE_POS[0] * sx)), int(round(CIRCLE_POS[1] * sy)))
+		axes = (int(round(CIRCLE_RADIUS * sx)), int(round(CIRCLE_RADIUS * sy)))
+		cv2.ellipse(mask, center, axes, 0, 0, 360, 255, thickness=-1)
+		return mask
+	
+	def fit(self, shape):
+		# Scale the reference and tray circle to a camera resolution. Parameter shape is (height, width).
+		if self._source is None:
+			self._source = cv2.imread(self.path, 0)
+		height, width = shape
+		src_height, src_width = self._source.shape
+		sx = width / float(src_width)
+		sy = height / float(src_height)
+		
+		if (height, width) == (src_height, src_width):
+			self.ref = self._source.copy()
+		else:
+			self.ref = cv2.resize(self._source, (width, height), interpolation=cv2.INTER_AREA)
+		self._ref_acc = self.ref.astype(np.float32)
+		
+		self.mask = self.mask_for(shape)
+		
+		self._grey = np.empty((height, width), dtype=np.uint8)
+		self._diff = np.empty((height, width), dtype=np.uint8)
+		# Pixels outside the mask are never written by the masked bitwise_and, so they stay zero.
+		self._masked = np.zeros((height, width), dtype=np.uint8)
+		self._thresh = np.empty((height, width), dtype=np.uint8)
+		self._fg = np.empty((height, width), dtype=np.uint8)
+		self.scale = (sx + sy) * 0.5
+		self.shape = (height, width)
+	
+	def grey(self, image):
+		# Greyscale version of a camera frame, in the model's buffer.
+		if image.ndim == 2:
+			return image
+		return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY, dst=self._grey)
+	
+	def subtract(self, grey):
+		# Difference from the background, inside the tray only.
+		cv2.absdiff(self.ref, grey, dst=self._diff)
+		return cv2.bitwise_and(self._diff, self._diff, dst=self._masked, mask=self.mask)
+	
+	def foreground(self, masked):
+		# Threshold the difference and remove speckle.
+		cv2.threshold(masked, self.THRESHOLD, 255, cv2.THRESH_BINARY, dst=self._thresh)
+		return cv2.morphologyEx(self._thresh, cv2.MORPH_OPEN, self._kernel, dst=self._fg)
+	
+	def apply(self, image):
+		# Run a frame through every stage, fitting to its resolution first if that has changed.
+		# Returns the greyscale frame and the foreground mask. Both are buffers reused by the next call.
+		if self.shape != image.shape[:2]:
+			self.fit(image.shape[:2])
+		grey = self.grey(image)
+		return grey, self.foreground(self.subtract(grey))
+	
+	def refresh(self, grey):
+		# Blend an empty tray frame into the background.
+		if self.learn_rate <= 0 or self.shape != grey.shape[:2]:
+			return
+		cv2.accumulateWeighted(grey, self._ref_acc, self.learn_rate)
+		cv2.convertScaleAbs(self._ref_acc, dst=self.ref)
 
 
-class MatchWithSIFT(object):
-	Reference_Points = namedtuple('Reference_Points', ['kp', 'des', 'img'])
+class SettleDetector(object):
+	# Decides when the dice have come to rest by differencing successive frames at low resolution inside the tray
+	# mask. Settled means the mean absolute difference stayed under threshold for the given number of consecutive
+	# frames. Replaces a fixed sleep after actuation, so a cycle takes only as long as the dice actually move.
+	def __init__(self, background, threshold=2.0, frames=3, timeout=3.0, scale=0.25):
+		self.background = background
+		self.threshold = threshold
+		self.frames = frames
+		self.timeout = timeout
+		self.scale = scale
+		self._shape = None
+		self._mask = None
+	
+	def _small(self, frame):
+		height = max(1, int(frame.shape[0] * self.scale))
+		width = max(1, int(frame.shape[1] * self.scale))
+		if self._shape != (height, width):
+			self._shape = (height, width)
+			self._mask = self.background.mask_for(self._shape)
+		small = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+		if small.ndim == 3:
+			small = cv2.cvtColor(small, cv2.COLOR_BGR2GRAY)
+		return small
+	
+	def wait(self, cam, since):
+		# Watch frames from a FrameGrabber captured after monotonic time since.
+		# Returns whether the dice settled before the timeout, and the last frame seen (the settled one if they did).
+		deadline = since + self.timeout
+		prev = None
+		still = 0
+		frame = None
+		t = since
+		while True:
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				return False, frame
+			latest, stamp = cam.next_frame(t, timeout=remaining)
+			if latest is None:
+				return False, frame
+			frame = latest
+			# Strictly newer than this one next time round
+			t = stamp + 1e-6
+			
+			small = self._small(frame)
+			if prev is not None:
+				motion = cv2.mean(cv2.absdiff(small, prev), mask=self._mask)[0]
+				still = still + 1 if motion < self.threshold else 0
+				if still >= self.frames:
+					return True, frame
+			prev = small
+
+
+class Segmenter(object):
+	# Finds dice in a foreground mask as connected components. A component too big to be one die is taken to be
+	# several touching dice and split with a watershed seeded from the peaks of its distance transform. Each die comes
+	# back as a cv2.KeyPoint: centre, diameter of a disc of the same area, and the angle in degrees of its principal
+	# axis, used to cut rotation-normalised crops. Areas are in reference image pixels and scaled to the camera.
+	MIN_AREA = 2000
+	# Bigger than this and a component is several dice
+	SPLIT_AREA = 32000
+	# Bigger than this and it isn't dice at all, e.g. a hand in the tray
+	MAX_AREA = 150000
+	# Distance transform peaks above this fraction of the component's maximum seed one die each
+	PEAK_FRACTION = 0.6
 	
 	def __init__(self):
-		self.sift = cv2.xfeatures2d.SIFT_create()
-		self.bf = cv2.BFMatcher()
-		self.ref_lib = dict()
+		self._labels = None
+	
+	def _keypoint(self, mask, x0, y0):
+		# KeyPoint for one die, given its mask and the mask's offset in the frame.
+		m = cv2.moments(mask, binaryImage=True)
+		if m['m00'] == 0:
+			return None
+		angle = 0.5 * np.degrees(np.arctan2(2.0 * m['mu11'], m['mu20'] - m['mu02']))
+		size = 2.0 * np.sqrt(m['m00'] / np.pi)
+		return cv2.KeyPoint(x0 + m['m10'] / m['m00'], y0 + m['m01'] / m['m00'], size, angle % 180.0)
+	
+	def _split(self, mask, min_area):
+		# Split one component's mask into dice. Returns a list of masks the same shape as the input.
+		# Pad by a pixel so the distance transform sees the edge of the bounding box as outside the die
+		padded = cv2.copyMakeBorder(mask, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
+		dist = cv2.distanceTransform(padded, cv2.DIST_L2, 5)
+		peaks = np.uint8(dist > self.PEAK_FRACTION * dist.max())
+		count, markers = cv2.connectedComponents(peaks)
+		if count <= 2:
+			# One peak, e.g. an elongated die
+			return [mask]
+		
+		# Peaks are 2 and up, outside the component 1, and the watershed fills in the zeros between.
+		markers += 1
+		markers[(padded > 0) & (peaks == 0)] = 0
+		relief = cv2.normalize(dist, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+		cv2.watershed(cv2.cvtColor(255 - relief, cv2.COLOR_GRAY2BGR), markers)
+		
+		pieces = []
+		for label in range(2, count + 1):
+			piece = np.uint8(markers[1:-1, 1:-1] == label)
+			if cv2.countNonZero(piece) >= min_area:
+				pieces.append(piece)
+		return pieces or [mask]
 	
-	def add_ref(self, key, img):
-		kp, des = self.sift.detectAndCompute(img, None)
-		self.ref_lib[key] = self.Reference_Points(kp, des, img)
+	def detect(self, fg, scale=1.0):
+		# Returns a KeyPoint per die in the foreground mask.
+		if self._labels is None or self._labels.shape != fg.shape:
+			self._labels = np.empty(fg.shape, dtype=np.int32)
+		area2 = scale * scale
+		min_area = self.MIN_AREA * area2
+		count, labels, stats, _ = cv2.connectedComponentsWithStats(
+			fg, labels=self._labels, connectivity=8, ltype=cv2.CV_32S)
+		
+		keypoints = []
+		for label in range(1, count):
+			x, y, w, h, area = stats[label]
+			if area < min_area or area > self.MAX_AREA * area2:
+				continue
+			mask = np.uint8(labels[y:y + h, x:x + w] == label)
+			pieces = [mask] if area <= self.SPLIT_AREA * area2 else self._split(mask, min_area)
+			for piece in pieces:
+				kp = self._keypoint(piece, x, y)
+				if kp is not None:
+					keypoints.append(kp)
+		return keypoints
+
+
+# One recognised die: its type name, face value and (x, y) centre in frame pixels, with the recogniser's confidence
+# score and its margin over the runner-up face.
+Detection = namedtuple('Detection', ['kind', 'value', 'pt', 'score', 'margin'], defaults=(1.0, 1.0))
+
+
+class Recognizer(object):
+	# Interface for die face recognisers. recognize() takes a greyscale die crop and returns the key of the best
+	# matching face ('type:face') or None, a confidence score from 0 to 1, and the margin of that score over the best
+	# other face. load_refs() prepares the references, and clone() returns a recogniser for another thread, sharing
+	# whatever read-only data it can.
+	def __init__(self, types=None):
+		# Parameter types is a list of DieType to recognise, by default every type with complete references.
+		self.types = types if types is not None else dietypes.active()
 	
 	def load_refs(self):
-		for i in range(1, 20 + 1):
-			self.add_ref(str(i), cv2.imread(os.path.join('refim', '{}-Grey.jpg'.format(i)), 0))
+		pass
+	
+	def recognize(self, img):
+		raise NotImplementedError
+	
+	def clone(self):
+		return self
+	
+	def find_match(self, img):
+		return self.recognize(img)[0]
+
+
+class MatchTemplates(Recognizer):
+	# Nearest neighbour on small normalised images. Each reference face is rotated in ROTATION_STEP degree steps and
+	# shrunk to SIZE pixels square, then a die crop is scored against all of them with one matrix product of
+	# zero-mean, unit-norm pixel vectors inside a circle. The score is the cosine similarity to the best face. Only
+	# needs stock OpenCV and numpy, and the template matrix is read-only, so threads share one instance.
+	SIZE = 32
+	ROTATION_STEP = 10
+	
+	def __init__(self, types=None):
+		super(MatchTemplates, self).__init__(types)
+		yy, xx = np.mgrid[:self.SIZE, :self.SIZE]
+		centre = (self.SIZE - 1) * 0.5
+		self._circle = ((xx - centre) ** 2 + (yy - centre) ** 2 <= (self.SIZE * 0.5) ** 2).ravel()
+		self.keys = []
+		# One row per template and the face it shows, as an index into keys
+		self.templates = None
+		self.labels = None
+	
+	def normalise(self, img):
+		small = cv2.resize(img, (self.SIZE, self.SIZE), interpolation=cv2.INTER_AREA)
+		vec = small.astype(np.float32).ravel()[self._circle]
+		vec -= vec.mean()
+		norm = np.linalg.norm(vec)
+		return vec / norm if norm > 0 else vec
+	
+	def load_refs(self):
+		rows = []
+		labels = []
+		self.keys = []
+		for t in self.types:
+			count = len(rows)
+			for key, path in t.sources().items():
+				img = cv2.imread(path, 0)
+				if img is None:
+					continue
+				key = dietypes.base_key(key)
+				if key not in self.keys:
+					self.keys.append(key)
+				height, width = img.shape
+				for angle in range(0, 360, self.ROTATION_STEP):
+					rot = cv2.getRotationMatrix2D((width * 0.5, height * 0.5), angle, 1.0)
+					rows.append(self.normalise(cv2.warpAffine(img, rot, (width, height))))
+					labels.append(self.keys.index(key))
+			if len(rows) == count:
+				print("No reference images for {} dice! Won't recognise them.".format(t.name))
+		self.templates = np.array(rows, dtype=np.float32).reshape(len(rows), np.count_nonzero(self._circle))
+		self.labels = np.array(labels, dtype=np.int32)
+	
+	def face_scores(self, img):
+		# Best similarity for each face, in keys order.
+		sims = self.templates.dot(self.normalise(img))
+		scores = np.full(len(self.keys), -1.0, dtype=np.float32)
+		np.maximum.at(scores, self.labels, sims)
+		return scores
 	
-	def knn_match(self, des1, des2):
-		matches = self.bf.knnMatch(des1, des2, k=2)
+	def recognize(self, img):
+		if not self.keys:
+			return None, 0.0, 0.0
+		scores = self.face_scores(img)
+		order = np.argsort(scores)[::-1]
+		best = max(0.0, float(scores[order[0]]))
+		runner_up = max(0.0, float(scores[order[1]])) if len(order) > 1 else 0.0
+		return self.keys[order[0]], best, best - runner_up
+
+
+class MatchWithSIFT(Recognizer):
+	# All reference descriptors live in one FLANN KD-tree, labelled by face. A query votes for faces through its
+	# nearest neighbours and only the leading candidates get the RANSAC homography check, so matching cost doesn't grow
+	# with the number of faces. Faces of every die type in use share the index, keyed 'type:face'. A face can have
+	# several reference images (see dietypes.DieType.sources); votes are summed per face, and the face's most voted
+	# image gets the check.
+	FLANN_INDEX_KDTREE = 1
+	# Faces given a homography check per query
+	CANDIDATES = 2
+	# findHomography needs at least four correspondences
+	MIN_VOTES = 4
+	# Homography inliers for full confidence
+	CONFIDENT_INLIERS = 20
+	
+	def __init__(self, index=None, types=None):
+		# Parameter index is an already loaded ReferenceIndex to share with other matchers.
+		super(MatchWithSIFT, self).__init__(types)
+		# SIFT moved into the main module in OpenCV 4.4, before that it is only in contrib builds
+		create = getattr(cv2, 'SIFT_create', None)
+		self.sift = create() if create is not None else cv2.xfeatures2d.SIFT_create()
+		if index is None:
+			index = ReferenceIndex('sift-' + '-'.join(t.name for t in self.types))
+		self.index = index
+		self.flann = None
+		# Face keys, and the face of each reference image as an index into them
+		self.faces = []
+		self.face_of = None
+	
+	def load_refs(self):
+		# Reference features come from the on-disk index, which is only rebuilt when a source image changes.
+		if len(self.index) == 0:
+			sources = OrderedDict()
+			for t in self.types:
+				sources.update(t.sources())
+			self.index.load_or_build(self.sift, sources)
+		
+		self.faces = []
+		face_of = []
+		for key in self.index.keys:
+			key = dietypes.base_key(key)
+			if key not in self.faces:
+				self.faces.append(key)
+			face_of.append(self.faces.index(key))
+		self.face_of = np.array(face_of, dtype=np.int64)
+		
+		self.flann = cv2.FlannBasedMatcher(dict(algorithm=self.FLANN_INDEX_KDTREE, trees=4), dict(checks=64))
+		self.flann.add([self.index.descriptors])
+		self.flann.train()
+	
+	def clone(self):
+		# SIFT and FLANN objects aren't safe to share between threads, the reference index is.
+		matcher = MatchWithSIFT(self.index, self.types)
+		matcher.load_refs()
+		return matcher
+	
+	def knn_match(self, des):
+		matches = self.flann.knnMatch(des, k=2)
 		# Use the Lowe ratio test to filter matches
-		return [m for (m, n) in matches if m.distance < 0.75 * n.distance]
+		return [m[0] for m in matches if len(m) == 2 and m[0].distance < 0.75 * m[1].distance]
 	
 	@staticmethod
-	def find_homography(kp1, kp2, matches):
-		src_points = np.float32([kp1[m.queryIdx].pt for m in matches]).reshape(-1, 1, 2)
-		dst_points = np.float32([kp2[m.trainIdx].pt for m in matches]).reshape(-1, 1, 2)
+	def find_homography(src_points, dst_points):
+		src_points = np.float32(src_points).reshape(-1, 1, 2)
+		dst_points = np.float32(dst_points).reshape(-1, 1, 2)
 		
 		M, mask = cv2.findHomography(src_points, dst_points, cv2.RANSAC, 10.0)
 		if mask is None:
@@ -72,47 +422,302 @@ class MatchWithSIFT(object):
 		# Homography matrix, mask, inlier count
 		return M, match_mask, np.count_nonzero(mask)
 	
-	def find_match(self, img):
+	def recognize(self, img):
 		img_kp, img_des = self.sift.detectAndCompute(img, None)
+		if img_des is None or len(img_des) < 2:
+			return None, 0.0, 0.0
+		img_pts = keypoints_to_array(img_kp)[:, :2]
 		
-		best_key = None
-		best_score = None
+		matches = self.knn_match(img_des)
+		if len(matches) < self.MIN_VOTES:
+			# Very poor match
+			return None, 0.0, 0.0
 		
-		for key, value in self.ref_lib.items():
-			matches = self.knn_match(value.des, img_des)
+		query = np.array([m.queryIdx for m in matches])
+		train = np.array([m.trainIdx for m in matches])
+		images = self.index.labels[train]
+		image_votes = np.bincount(images, minlength=len(self.index))
+		votes = np.bincount(self.face_of, weights=image_votes, minlength=len(self.faces))
+		
+		# Inliers of the most voted image of each candidate face
+		inliers_by_key = dict()
+		
+		for face in np.argsort(votes)[::-1][:self.CANDIDATES]:
+			if votes[face] < self.MIN_VOTES:
+				break
 			
-			if len(matches) < 2:
-				# Very poor match
+			mine = np.flatnonzero(self.face_of == face)
+			image = mine[np.argmax(image_votes[mine])]
+			sel = images == image
+			if np.count_nonzero(sel) < self.MIN_VOTES:
+				inliers_by_key[self.faces[face]] = 0
 				continue
-			
-			M, matches_mask, inliers = self.find_homography(value.kp, img_kp, matches)
-			
-			if inliers < 10:
-				# Poor match not enough matched points
-				# continue
-				pass
-			
-			try:
-				test_out = cv2.drawMatches(img, img_kp, value.img, value.kp, matches, None)
-				
-				# cv2.imshow("Keypoint", test_out)
-				# cv2.waitKey(0)
-			except Exception as e:
-				pass
-			
-			if inliers > best_score:
-				best_score = inliers
-				best_key = key
+			# Few inliers give a low score, see CONFIDENT_INLIERS, and so go to the review queue
+			_, _, inliers = self.find_homography(self.index.keypoints[train[sel], :2], img_pts[query[sel]])
+			inliers_by_key[self.faces[face]] = inliers
 		
-		return best_key
+		ranked = sorted(inliers_by_key.items(), key=lambda item: item[1], reverse=True)
+		if not ranked or ranked[0][1] == 0:
+			return None, 0.0, 0.0
+		best = min(1.0, ranked[0][1] / float(self.CONFIDENT_INLIERS))
+		runner_up = min(1.0, ranked[1][1] / float(self.CONFIDENT_INLIERS)) if len(ranked) > 1 else 0.0
+		return ranked[0][0], best, best - runner_up
+
+
+class CascadeRecognizer(Recognizer):
+	# Tries a fast recogniser first and only asks the slow one about crops it isn't confident of: a score below accept,
+	# or a margin over the runner-up face below accept_margin; the template matcher's wrong answers can score high, but
+	# with a thin margin. If the slow one finds nothing, the fast one's answer stands.
+	def __init__(self, fast, slow, accept=0.8, accept_margin=0.1):
+		super(CascadeRecognizer, self).__init__(fast.types)
+		self.fast = fast
+		self.slow = slow
+		self.accept = accept
+		self.accept_margin = accept_margin
+	
+	def load_refs(self):
+		self.fast.load_refs()
+		self.slow.load_refs()
+	
+	def clone(self):
+		return CascadeRecognizer(self.fast.clone(), self.slow.clone(), self.accept, self.accept_margin)
+	
+	def recognize(self, img):
+		result = self.fast.recognize(img)
+		if result[1] >= self.accept and result[2] >= self.accept_margin:
+			return result
+		slow = self.slow.recognize(img)
+		return result if slow[0] is None else slow
+
+
+# Recogniser backends by name. 'auto' is templates with a SIFT fallback, or templates alone without SIFT.
+RECOGNIZERS = ('auto', 'template', 'sift')
+
+
+def make_recognizer(backend='auto', types=None):
+	# Build a recogniser and load its references. Raises AttributeError or cv2.error if it needs SIFT and SIFT isn't
+	# available, except for 'auto' which then does without.
+	if backend not in RECOGNIZERS:
+		raise ValueError("unknown recogniser " + backend)
+	if backend == 'sift':
+		recognizer = MatchWithSIFT(types=types)
+		recognizer.load_refs()
+		return recognizer
+	
+	recognizer = MatchTemplates(types)
+	recognizer.load_refs()
+	if backend == 'auto':
+		try:
+			slow = MatchWithSIFT(types=recognizer.types)
+			slow.load_refs()
+		except (AttributeError, cv2.error):
+			print("SIFT not available! Using template matching only.")
+		else:
+			recognizer = CascadeRecognizer(recognizer, slow)
+	return recognizer
+
+
+# Recogniser owned by each process of a process pool
+_worker_recognizer = None
+
+
+def _init_worker(backend, type_args):
+	# Parameter type_args holds (name, sides, path) per die type, since worker processes may not share the registry.
+	global _worker_recognizer
+	try:
+		_worker_recognizer = make_recognizer(backend, [dietypes.DieType(*args) for args in type_args])
+	except (AttributeError, cv2.error):
+		_worker_recognizer = None
+
+
+def _match_crop(recognizer, crop):
+	# Recognise one colour or greyscale die crop, returning the face key (or None), score, margin and the seconds it
+	# took.
+	start = time.perf_counter()
+	key, score, margin = None, 0.0, 0.0
+	if recognizer is not None and crop.size > 0:
+		if crop.ndim == 3:
+			crop = cv2.cvtColor(crop, cv2.COLOR_BGR2GRAY)
+		key, score, margin = recognizer.recognize(crop)
+	return key, score, margin, time.perf_counter() - start
+
+
+def _match_in_worker(crop):
+	return _match_crop(_worker_recognizer, crop)
+
+
+class MatchPool(object):
+	# Runs die crops through a pool of recognisers and returns the results in submission order.
+	# OpenCV drops the GIL while matching, so threads are the default. Each thread gets a clone of the recogniser,
+	# see Recognizer.clone. Process pool workers build their own from the backend name.
+	def __init__(self, recognizer, workers=None, processes=False, backend='auto'):
+		self.recognizer = recognizer
+		self.types = recognizer.types
+		self.backend = backend
+		self.workers = workers or os.cpu_count() or 1
+		self.processes = processes
+		self._local = threading.local()
+		self._executor = None
+	
+	def start(self):
+		if self.processes:
+			type_args = [(t.name, t.sides, t.path) for t in self.types]
+			self._executor = ProcessPoolExecutor(
+				self.workers, initializer=_init_worker, initargs=(self.backend, type_args))
+		else:
+			self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='match')
+	
+	def stop(self):
+		if self._executor is not None:
+			self._executor.shutdown(wait=True)
+			self._executor = None
+	
+	def _thread_match(self, crop):
+		recognizer = getattr(self._local, 'recognizer', None)
+		if recognizer is None:
+			recognizer = self.recognizer.clone()
+			self._local.recognizer = recognizer
+		return _match_crop(recognizer, crop)
+	
+	def match_scored(self, crops):
+		# Returns (key, score, margin) for each crop, the seconds spent matching each crop, and the wall time for the
+		# whole batch. Timings are handed back rather than kept, as one pool can serve several callers at once.
+		start = time.perf_counter()
+		func = _match_in_worker if self.processes else self._thread_match
+		results = list(self._executor.map(func, crops))
+		wall_time = time.perf_counter() - start
+		timings = [result[3] for result in results]
+		for t in timings:
+			perf.stages.record('die', t)
+		return [result[:3] for result in results], timings, wall_time
+	
+	def match(self, crops):
+		return [key for key, _, _ in self.match_scored(crops)[0]]
+
+
+def open_match_pool(workers=None, processes=False, types=None, backend='auto'):
+	# Load the reference library and start a MatchPool on it. Returns None if the backend can't be used.
+	try:
+		recognizer = make_recognizer(backend, types)
+	except (AttributeError, cv2.error):
+		print("SIFT not available! Won't parse dice!")
+		return None
+	pool = MatchPool(recognizer, workers, processes, backend)
+	pool.start()
+	return pool
+
+
+class DiceFinder(object):
+	# Everything that turns a frame into dice values, with no camera or shaker attached. The background model holds
+	# per-frame buffers, so a finder must only be used from one thread at a time. Several finders can share a pool.
+	# Crops recognised with a lower score or margin than these are copied to the review queue
+	REVIEW_SCORE = 0.5
+	REVIEW_MARGIN = 0.05
+	
+	def __init__(self, pool, background=None, review=None, min_score=REVIEW_SCORE, min_margin=REVIEW_MARGIN):
+		# Parameter review is a ReviewQueue for unrecognised and low confidence crops, or None.
+		# Detections scoring under min_score or with a margin under min_margin are left out of the results, as are
+		# crops that match nothing, and counted in self.rejected. By default that is every crop sent for review, so a
+		# doubtful die or a blob that isn't a die never becomes a roll.
+		self.pool = pool
+		self.background = background if background is not None else BackgroundModel()
+		self.segmenter = Segmenter()
+		self.review = review
+		self.min_score = min_score
+		self.min_margin = min_margin
+		self.rejected = 0
+		# Seconds spent matching each crop of the last frame, in keypoint order, and for all of them together
+		self.die_times = []
+		self.match_time = 0.0
+	
+	def detect(self, fg):
+		# Find dice in a foreground mask.
+		return self.segmenter.detect(fg, self.background.scale)
+	
+	def crop(self, image, keypoints):
+		# Cut a die sized square out of the frame around each die, rotated so its principal axis is horizontal.
+		# Every crop is the same size; parts that fall outside the frame are black.
+		side = max(1, int(round(DICE_SIZE * self.background.scale)))
+		crops = list()
+		for point in keypoints:
+			x, y = point.pt
+			rot = cv2.getRotationMatrix2D((x, y), point.angle, 1.0)
+			# Move the die centre to the middle of the crop
+			rot[0, 2] += side * 0.5 - x
+			rot[1, 2] += side * 0.5 - y
+			crops.append(cv2.warpAffine(image, rot, (side, side), flags=cv2.INTER_LINEAR,
+				borderMode=cv2.BORDER_CONSTANT, borderValue=0))
+		return crops
+	
+	def match(self, crops, keypoints):
+		# Detections for the crops that matched a reference face, in keypoint order.
+		out_arr = list()
+		if self.pool is not None:
+			results, self.die_times, self.match_time = self.pool.match_scored(crops)
+			for (key, score, margin), crop, point in zip(results, crops, keypoints):
+				doubtful = key is None or score < self.REVIEW_SCORE or margin < self.REVIEW_MARGIN
+				if self.review is not None and doubtful:
+					self.review.add(crop, key, score, margin)
+				if key is None or score < self.min_score or margin < self.min_margin:
+					self.rejected += 1
+					continue
+				kind, value = dietypes.parse_key(key)
+				out_arr.append(Detection(kind, value, point.pt, score, margin))
+		return out_arr
+	
+	def process(self, image):
+		# Process an opencv image to find dice.
+		# Will return two values:
+		# - a list of Detections, one per recognised die.
+		# - a version of the source image with additional cool markup.
+		with perf.stages.time('segment'):
+			img, threshold_img = self.background.apply(image)
+			keypoints = self.detect(threshold_img)
+			if not keypoints:
+				self.background.refresh(img)
+		
+		with perf.stages.time('match'):
+			out_arr = self.match(self.crop(image, keypoints), keypoints)
+		
+		# Draw detected blobs as red circles.
+		# cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS ensures the size of the circle corresponds to the size of blob
+		image = cv2.drawKeypoints(threshold_img, keypoints, np.array([]), (0, 255, 0), cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
+		
+		return out_arr, image
 
 
 class VisionThread(threading.Thread):
-	def __init__(self, group=None, target=None, name=None):
+	def __init__(self, group=None, target=None, name=None, workers=None, processes=False, pipelined=False,
+				queue_size=8, settle=True, cam=None, motion=None, pool=None, review=None):
+		# Parameters workers and processes configure the die matching pool, see MatchPool. Alternatively pool is an
+		# already started MatchPool, e.g. one shared by several rigs, which this thread then leaves running. Parameter
+		# review is a ReviewQueue to share in the same way.
+		# Parameters cam and motion replace the platform's camera and the serial shaker, e.g. with sim.SimCam and
+		# sim.SimMotion. Motion is otherwise opened on this thread when it starts.
+		# With settle, each roll waits for the dice to stop moving in the camera image rather than a fixed time, see
+		# SettleDetector. Without it the original timed roll is used.
+		# In pipelined mode a single sample() keeps the rig rolling: each frame is handed to an analysis thread as soon
+		# as it is captured and the next roll starts straight away. Results then arrive on the bounded results queue,
+		# which the caller must drain, as (dice, frame) tuples.
+		# Attribute rejected counts the crops left out of the results, see DiceFinder; like dice, it is updated with
+		# each published frame.
+		# Attribute notify, if set, is called on the vision side with no arguments each time a result is ready, on the
+		# results queue or for wait_results(), so a caller can wake up for it rather than poll.
 		super(VisionThread, self).__init__(group=group, target=target, name=name)
 		
-		self._cam = cameras.get_best_cam()()
-		self._sift = None
+		self.pipelined = pipelined
+		self.results = queue.Queue(maxsize=queue_size)
+		self._frames = queue.Queue(maxsize=1)
+		
+		self._cam = cameras.FrameGrabber(cam if cam is not None else cameras.get_best_cam()())
+		self._motion = motion
+		self._workers = workers
+		self._processes = processes
+		self._pool = pool
+		self._own_pool = pool is None
+		self._finder = DiceFinder(None, review=review if review is not None else ReviewQueue())
+		# Own background model, as the finder's belongs to whichever thread does the analysis
+		self._settle = SettleDetector(BackgroundModel()) if settle else None
 		
 		self.conlock = threading.Condition()
 		self._apprun = True
@@ -123,14 +728,23 @@ class VisionThread(threading.Thread):
 		self.dice = []
 		self.frame = None
 		self.fresh = False
+		# Seconds spent matching each die of the last frame, in keypoint order, and for all of them together
+		self.die_times = []
+		self.match_time = 0.0
+		self.rejected = 0
+		self._last_publish = None
+		self.notify = None
 	
 	def run(self):
-		motion = Motion()
-		try:
-			self._sift = MatchWithSIFT()
-			self._sift.load_refs()
-		except (AttributeError, cv2.error):
-			print("SIFT not available! Won't parse dice!")
+		motion = self._motion if self._motion is not None else Motion()
+		if self._own_pool:
+			self._pool = open_match_pool(self._workers, self._processes)
+		self._finder.pool = self._pool
+		
+		analyser = None
+		if self.pipelined:
+			analyser = threading.Thread(target=self._analyse, name='analyse')
+			analyser.start()
 		
 		_run = False
 		_stop = False
@@ -155,23 +769,88 @@ class VisionThread(threading.Thread):
 				if not _sample:
 					continue
 				
-				motion.roll()
 				frame = None
-				while frame is None:
-					frame = self._cam.get_frame()
-				dice, frame = self._process_image(frame)
+				if self._settle is not None:
+					with perf.stages.time('roll'):
+						motion.actuate()
+					with perf.stages.time('settle'):
+						still, frame = self._settle.wait(self._cam, time.monotonic())
+					if not still:
+						# Score the frame anyway, but it may be blurred or catch a die on its edge
+						print("Dice didn't settle!")
+				else:
+					with perf.stages.time('roll'):
+						motion.roll()
+					settled = time.monotonic()
+					with perf.stages.time('capture'):
+						# Never score a frame from before the dice came to rest
+						while frame is None and self._cam.ready():
+							frame = self._cam.get_frame_after(settled, timeout=1.0)
+				if frame is None:
+					break
 				
+				if self.pipelined:
+					# Analysis overlaps with the next roll, this only blocks if analysis falls behind.
+					self._put(self._frames, frame)
+					continue
+				
+				dice, frame = self._process_image(frame)
 				with self.conlock:
 					self._sample = False
-				with self.reslock:
-					self.dice = dice
-					self.frame = frame
-					self.fresh = True
-					self.reslock.notify()
+				self._publish(dice, frame)
+				self._notify()
 			
 			self._cam.stop()
 			with self.conlock:
 				_run = self._apprun
+		
+		if analyser is not None:
+			self._frames.put(None)
+			analyser.join()
+		if self._own_pool and self._pool is not None:
+			self._pool.stop()
+		self._finder.review.flush()
+		motion.close()
+	
+	def _analyse(self):
+		# Pipelined mode analysis loop, fed from the capture loop in run().
+		while True:
+			frame = self._frames.get()
+			if frame is None:
+				break
+			dice, frame = self._process_image(frame)
+			self._publish(dice, frame)
+			if self._put(self.results, (dice, frame)):
+				self._notify()
+	
+	def _put(self, q, item):
+		# Blocking put that gives up once the thread is told to stop, so a caller that stops draining can't deadlock it.
+		while True:
+			try:
+				q.put(item, timeout=0.1)
+				return True
+			except queue.Full:
+				with self.conlock:
+					if self._appstop:
+						return False
+	
+	def _notify(self):
+		if self.notify is not None:
+			self.notify()
+	
+	def _publish(self, dice, frame):
+		now = time.perf_counter()
+		if self._last_publish is not None:
+			perf.stages.record('cycle', now - self._last_publish)
+		self._last_publish = now
+		with self.reslock:
+			self.dice = dice
+			self.frame = frame
+			self.die_times = self._finder.die_times
+			self.match_time = self._finder.match_time
+			self.rejected = self._finder.rejected
+			self.fresh = True
+			self.reslock.notify()
 	
 	def stop(self):
 		with self.conlock:
@@ -187,6 +866,12 @@ class VisionThread(threading.Thread):
 			self._sample = False
 			self.conlock.notify()
 	
+	def pause(self):
+		# Stop rolling after the current actuation, until the next sample().
+		with self.conlock:
+			self._sample = False
+			self.conlock.notify()
+	
 	def sample(self):
 		with self.conlock:
 			self._apprun = True
@@ -207,67 +892,5 @@ class VisionThread(threading.Thread):
 		self.restart()
 	
 	def _process_image(self, image):
-		# Process an opencv image to find dice.
-		# Will return two values:
-		# - a list of 20-sided dice rolls.
-		# - a version of the source image with additional cool markup.
-		img = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-		ref = cv2.imread(os.path.join('refim', 'ref.jpg'), 0)
-		if img.shape[0] != ref.shape[0] or img.shape[1] != ref.shape[1]:
-			print("Ref image size mismatch!")
-			image = cv2.resize(image, (ref.shape[1], ref.shape[0]))
-			img = cv2.resize(img, (ref.shape[1], ref.shape[0]))
-		
-		masked_img = subtract_and_mask(img, ref)
-		
-		# cv2.imshow('image', masked_img)
-		# cv2.waitKey(0)
-		
-		ret, threshold_img = cv2.threshold(masked_img, 25, 255, cv2.THRESH_BINARY)
-		kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE,(5,5))
-		threshold_img = cv2.morphologyEx(threshold_img, cv2.MORPH_OPEN, kernel)
-		
-		
-		# Setup SimpleBlobDetector parameters.
-		params = cv2.SimpleBlobDetector_Params()
-		
-		params.blobColor = 255
-		params.filterByColor = True
-		params.filterByArea = True
-		params.minDistBetweenBlobs = 2
-		params.minArea = 2000
-		# Blobs larger than 50 pixels are noise
-		params.maxArea = 50000
-		# enabling these can cause us to miss points
-		params.filterByCircularity = False
-		params.filterByConvexity = False
-		params.filterByInertia = False
-		
-		# Create a detector with the parameters
-		detector = cv2.SimpleBlobDetector_create(params)
-		
-		# Detect blobs.
-		keypoints = detector.detect(threshold_img)
-		
-		out_arr = list()
-		
-		for i, point in enumerate(keypoints):
-			y, x = point.pt
-			found_dice = image[int(x - DICE_SIZE * 0.5):int(x - DICE_SIZE * 0.5 + DICE_SIZE), int(y - DICE_SIZE * 0.5):int(y - DICE_SIZE * 0.5 + DICE_SIZE)]
-			
-			die_num = None
-			if self._sift is not None:
-				dice_grey = cv2.cvtColor(found_dice, cv2.COLOR_BGR2GRAY)
-				die_num = self._sift.find_match(dice_grey)
-			if die_num is not None:
-				out_arr.append(int(die_num))
-			
-			# img_col = cv2.putText(img_col, str(die_num), (int(y) - 10, int(x) + 10), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-			# cv2.imshow("Keypoint", found_dice)
-			# cv2.waitKey(0)
-		
-		# Draw detected blobs as red circles.
-		# cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS ensures the size of the circle corresponds to the size of blob
-		image = cv2.drawKeypoints(threshold_img, keypoints, np.array([]), (0, 255, 0), cv2.DRAW_MATCHES_FLAGS_DRAW_RICH_KEYPOINTS)
-		
-		return out_arr, image
+		with perf.stages.time('process'):
+			return self._finder.process(image)